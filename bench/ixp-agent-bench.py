@@ -0,0 +1,531 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Offline benchmark for the IXP agent
+
+Runs the agent's own code paths (Handle_Notification -> reconcile, and the
+gNMI neighbor event path) against local stand-ins:
+- a fake PeeringDB + irrexplorer HTTP server with synthetic netixlan/prefix data
+- a fake gNMI server (Capabilities, Get, Set, Subscribe) on an in-memory tree,
+  listening on a unix socket like sr_gnmi_server
+
+Each size runs in a fresh (spawned) process, such that peak RSS is per size.
+NDK is not used: notifications are fed to Handle_Notification directly, and
+telemetry is kept in memory (the publisher thread is not started)
+
+Usage: python3 bench/ixp-agent-bench.py [--peers 10,100,1000,5000] [--prefixes 100000]
+Exits non-zero when a phase fails (its row is marked FAILED)
+Requires the agent's python dependencies (grpcio, pygnmi, requests)
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from concurrent import futures
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from ipaddress import IPv4Network, IPv6Network
+from urllib.parse import urlparse, parse_qs
+
+AGENT = os.path.join( os.path.dirname(os.path.abspath(__file__)),
+                      '..', 'src', 'ixp-agent', 'ixp-agent.py' )
+IX = "BENCH-IX Main"
+BASE_AS = 64512
+
+############################################################
+## Synthetic PeeringDB / IRR data
+############################################################
+def netixlan(asns):
+    rows = []
+    for i, asn in enumerate(asns):
+      rows.append( { 'id': i+1, 'asn': asn, 'name': IX, 'status': 'ok',
+                     'ipaddr4': str( IPv4Network('100.64.0.0/10')[i+1] ),
+                     'ipaddr6': f"2001:db8:ffff::{i+1:x}" } )
+    return rows
+
+def prefixes(index, per_as):
+    """
+    Mostly adjacent IPv4 /24s (aggregatable) plus a quarter IPv6 /48s
+    """
+    v6 = per_as // 4
+    out = []
+    base4 = (11 << 24) + index * (per_as - v6) * 256
+    for j in range(per_as - v6):
+      out.append( f"{IPv4Network((base4 + j*256) & 0xFFFFFFFF).network_address}/24" )
+    for j in range(v6):
+      out.append( str( IPv6Network( ((0x2a00 << 112) + ((index*v6 + j) << 80), 48) ) ) )
+    return out
+
+class HttpStats:
+    requests = 0
+    bytes = 0
+
+def http_handler(asns, per_as):
+    index = { asn: i for i, asn in enumerate(asns) }
+
+    class Handler(BaseHTTPRequestHandler):
+      def log_message(self, *args):
+        pass
+
+      def do_GET(self):
+        url = urlparse(self.path)
+        args = parse_qs(url.query)
+        if url.path == '/api/netixlan':
+          data = [] if 'since' in args else netixlan(asns)
+          body = { 'meta': {}, 'data': data }
+        elif url.path == '/api/net':
+          wanted = [ int(a) for a in args.get('asn__in',[''])[0].split(',') if a ]
+          body = { 'meta': {}, 'data': [ { 'asn': a, 'info_prefixes4': per_as,
+                                           'info_prefixes6': per_as // 4 } for a in wanted ] }
+        elif url.path.startswith('/api/prefixes/asn/AS'):
+          asn = int( url.path.split('AS')[-1] )
+          body = { 'directOrigin': [],
+                   'overlaps': [ { 'prefix': p, 'goodnessOverall': 1, 'bgpOrigins': [asn] }
+                                 for p in prefixes( index.get(asn,0), per_as ) ] }
+        else:
+          self.send_error(404)
+          return
+        payload = json.dumps(body).encode()
+        HttpStats.requests += 1
+        HttpStats.bytes += len(payload)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    return Handler
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+############################################################
+## Fake gNMI server on an in-memory tree
+############################################################
+def gnmi_protos():
+    try:
+      from pygnmi.spec.v080 import gnmi_pb2, gnmi_pb2_grpc
+    except ImportError:
+      from pygnmi.spec import gnmi_pb2, gnmi_pb2_grpc
+    return gnmi_pb2, gnmi_pb2_grpc
+
+def elems(path, prefix=None):
+    """
+    gNMI Path (plus optional prefix) -> tuple of (name, ((key,value),...))
+    """
+    out = []
+    for p in ([prefix] if prefix is not None else []) + [path]:
+      out += [ (e.name, tuple(sorted(e.key.items()))) for e in p.elem ]
+    return tuple(out)
+
+def matches(pattern, path):
+    """
+    True if 'path' is at or below 'pattern'; '*' key values match anything
+    """
+    if len(path) < len(pattern):
+      return False
+    for (pn, pk), (n, k) in zip(pattern, path):
+      if pn != n:
+        return False
+      kd = dict(k)
+      for key, val in pk:
+        if val != '*' and kd.get(key) != val:
+          return False
+    return True
+
+def decode(tv):
+    kind = tv.WhichOneof('value')
+    if kind in ('json_ietf_val', 'json_val'):
+      return json.loads( getattr(tv, kind) )
+    return getattr(tv, kind)
+
+class Tree:
+    """
+    Flat store of objects keyed by their (keyed) path
+    """
+    def __init__(self):
+      self.lock = threading.Lock()
+      self.objects = {}
+
+    def update(self, path, val):
+      cur = self.objects.get(path)
+      if isinstance(cur, dict) and isinstance(val, dict):
+        cur.update(val)
+      else:
+        self.objects[path] = val
+
+    def delete(self, path):
+      for p in [ p for p in self.objects if matches(path, p) ]:
+        del self.objects[p]
+
+    def get(self, path):
+      """
+      JSON rooted at the parent of 'path', e.g. {"entry": [...]}
+      """
+      root = {}
+      for p, val in self.objects.items():
+        if not matches(path, p):
+          continue
+        parent, node = None, root
+        for name, keys in p[len(path)-1:]:
+          parent = node
+          if keys:
+            entries = node.setdefault(name, [])
+            node = next( (e for e in entries if all(e.get(k) == v for k, v in keys)), None )
+            if node is None:
+              node = dict(keys)
+              entries.append(node)
+          else:
+            node = node.setdefault(name, {})
+        if isinstance(val, dict):
+          node.update(val)
+        else:
+          parent[ p[-1][0] ] = val
+      return root
+
+def leaves(path, val):
+    """
+    Flattens an object into leaf updates, like on_change subscriptions do
+    """
+    if isinstance(val, dict) and val:
+      for k, v in val.items():
+        yield from leaves( path + ((k, ()),), v )
+    else:
+      yield path, val
+
+class GnmiStats:
+    def __init__(self):
+      self.calls = {}
+      self.bytes = 0
+
+    def count(self, rpc, *msgs):
+      self.calls[rpc] = self.calls.get(rpc, 0) + 1
+      self.bytes += sum( m.ByteSize() for m in msgs )
+
+def gnmi_servicer(tree, stats):
+    gnmi_pb2, gnmi_pb2_grpc = gnmi_protos()
+
+    def to_path(p):
+      return gnmi_pb2.Path( elem=[ gnmi_pb2.PathElem(name=n, key=dict(k)) for n, k in p ] )
+
+    class Servicer(gnmi_pb2_grpc.gNMIServicer):
+      def __init__(self):
+        self.subscribers = []   # (patterns, queue)
+
+      def notify(self, path, val=None, delete=False):
+        for patterns, q in list(self.subscribers):
+          if any( matches(pat, path) for pat in patterns ):
+            q.put( (path, val, delete) )
+
+      def Capabilities(self, request, context):
+        resp = gnmi_pb2.CapabilityResponse( gNMI_version="0.7.0",
+                 supported_encodings=[gnmi_pb2.JSON, gnmi_pb2.JSON_IETF] )
+        stats.count('Capabilities', request, resp)
+        return resp
+
+      def Get(self, request, context):
+        notifications = []
+        with tree.lock:
+          for p in request.path:
+            path = elems(p, request.prefix if request.HasField('prefix') else None)
+            val = tree.get(path)
+            notifications.append( gnmi_pb2.Notification( timestamp=int(time.time()*1e9),
+              update=[ gnmi_pb2.Update( path=to_path(path[:-1]),
+                         val=gnmi_pb2.TypedValue( json_ietf_val=json.dumps(val).encode() ) ) ] ) )
+        resp = gnmi_pb2.GetResponse( notification=notifications )
+        stats.count('Get', request, resp)
+        return resp
+
+      def Set(self, request, context):
+        prefix = request.prefix if request.HasField('prefix') else None
+        results = []
+        with tree.lock:
+          for d in request.delete:
+            path = elems(d, prefix)
+            tree.delete(path)
+            self.notify(path, delete=True)
+            results.append( gnmi_pb2.UpdateResult( path=d, op=gnmi_pb2.UpdateResult.DELETE ) )
+          for op, ups in ( (gnmi_pb2.UpdateResult.REPLACE, request.replace),
+                           (gnmi_pb2.UpdateResult.UPDATE, request.update) ):
+            for u in ups:
+              path = elems(u.path, prefix)
+              if op == gnmi_pb2.UpdateResult.REPLACE:
+                tree.delete(path)
+              val = decode(u.val)
+              tree.update(path, val)
+              for leaf, v in leaves(path, val):
+                self.notify(leaf, v)
+              results.append( gnmi_pb2.UpdateResult( path=u.path, op=op ) )
+        resp = gnmi_pb2.SetResponse( response=results, timestamp=int(time.time()*1e9) )
+        stats.count('Set', request, resp)
+        return resp
+
+      def Subscribe(self, request_iterator, context):
+        request = next(request_iterator)
+        stats.count('Subscribe', request)
+        sl = request.subscribe
+        prefix = sl.prefix if sl.HasField('prefix') else None
+        patterns = [ elems(s.path, prefix) for s in sl.subscription ]
+        q = queue.Queue()
+        with tree.lock:
+          initial = [ (p, v) for p, v in tree.objects.items()
+                      if any( matches(pat, p) for pat in patterns ) ]
+          self.subscribers.append( (patterns, q) )
+        try:
+          for p, v in initial:
+            for leaf, lv in leaves(p, v):
+              yield self._update(leaf, lv)
+          yield gnmi_pb2.SubscribeResponse( sync_response=True )
+          while context.is_active():
+            try:
+              path, val, delete = q.get( timeout=0.5 )
+            except queue.Empty:
+              continue
+            if delete:
+              msg = gnmi_pb2.SubscribeResponse( update=gnmi_pb2.Notification(
+                      timestamp=int(time.time()*1e9), delete=[to_path(path)] ) )
+            else:
+              msg = self._update(path, val)
+            stats.count('SubscribeResponse', msg)
+            yield msg
+        finally:
+          self.subscribers.remove( (patterns, q) )
+
+      def _update(self, path, val):
+        return gnmi_pb2.SubscribeResponse( update=gnmi_pb2.Notification(
+                 timestamp=int(time.time()*1e9),
+                 update=[ gnmi_pb2.Update( path=to_path(path),
+                            val=gnmi_pb2.TypedValue( json_val=json.dumps(val).encode() ) ) ] ) )
+
+    return Servicer(), gnmi_pb2_grpc
+
+def start_gnmi(sock, tree, stats):
+    import grpc
+    servicer, gnmi_pb2_grpc = gnmi_servicer(tree, stats)
+    server = grpc.server( futures.ThreadPoolExecutor(max_workers=16),
+                          options=[ ('grpc.max_receive_message_length', 64*1024*1024),
+                                    ('grpc.max_send_message_length', 64*1024*1024) ] )
+    gnmi_pb2_grpc.add_gNMIServicer_to_server(servicer, server)
+    server.add_insecure_port( 'unix:' + sock )
+    server.start()
+    return server, servicer
+
+############################################################
+## Driving the agent
+############################################################
+class Config:
+    """
+    Stand-in for an NDK config notification
+    """
+    class _Data:
+      def __init__(self, json):
+        self.json = json
+
+    class _Key:
+      def __init__(self, js_path, keys):
+        self.js_path = js_path
+        self.keys = keys
+
+    class _Config:
+      def __init__(self, js_path, data):
+        self.key = Config._Key(js_path, [])
+        self.op = 1
+        self.data = Config._Data(json.dumps(data))
+
+    def __init__(self, data, js_path='.ixp_agent'):
+      self.config = Config._Config(js_path, data)
+
+    def HasField(self, name):
+      return name == 'config'
+
+def load_agent(tmp, gnmi_sock, http_port):
+    spec = importlib.util.spec_from_file_location( 'ixp_agent', AGENT )
+    agent = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(agent)
+    agent.mgmt_netns = None
+    agent.cache_file = os.path.join(tmp, 'cache.sqlite')
+    agent.peeringdb_api = f'http://127.0.0.1:{http_port}/api'
+    agent.irrexplorer_api = f'http://127.0.0.1:{http_port}/api'
+    agent.gnmi_connection.target = ( 'unix://' + gnmi_sock, 57400 )
+    agent.event_settle_time = 0.05
+    agent.startup_done.set()
+    return agent
+
+def check_order(agent):
+    """
+    Regression check for Reconciler.desired()/diff(): objects are created
+    before and deleted after the objects that refer to them
+    """
+    instance = agent.Reconciler( 'bench-check', '.bench_check' )
+    pfx = agent.PrefixList()
+    pfx.add( '192.0.2.0/24' )
+    pfx.add( '2001:db8::/32' )
+    desired = instance.desired( { BASE_AS: ( 'check', '100.64.0.1', '2001:db8:ffff::1',
+                                             pfx, (10, 10) ) } )
+    kinds = [ instance._kind(o[1]) for o in instance.diff(desired, {}, set()).ops ]
+    assert kinds and kinds == sorted(kinds), f"creates out of order: {kinds}"
+    running = { path: (BASE_AS if '/routing-policy/' in path else None, val)
+                for path, val in desired.items() }
+    ops = instance.diff({}, running, set()).ops
+    assert len(ops) == len(desired) and all( o[0] == 'delete' for o in ops ), ops
+    kinds = [ instance._kind(o[1]) for o in ops ]
+    assert kinds == sorted(kinds, reverse=True), f"deletes out of order: {kinds}"
+
+def acl_entries(tree):
+    with tree.lock:
+      return sum( 1 for p in tree.objects if p and p[0][0] == 'acl' )
+
+def scenario(peers, total_prefixes, results):
+    import logging
+    logging.basicConfig( level=logging.WARNING )
+    per_as = max( total_prefixes // peers, 1 )
+    asns = [ BASE_AS + i for i in range(peers + 1) ] # Last one is added later
+    tmp = tempfile.mkdtemp( prefix='ixp-bench-' )
+    sock = os.path.join(tmp, 'gnmi.sock')
+
+    httpd = ThreadingHTTPServer( ('127.0.0.1', 0), http_handler(asns, per_as) )
+    threading.Thread( target=httpd.serve_forever, daemon=True ).start()
+    tree, stats = Tree(), GnmiStats()
+    server, servicer = start_gnmi(sock, tree, stats)
+    agent = load_agent(tmp, sock, httpd.server_address[1])
+
+    def run(name, data):
+      calls0, bytes0 = dict(stats.calls), stats.bytes
+      http0, hbytes0 = HttpStats.requests, HttpStats.bytes
+      t0 = time.monotonic()
+      failed = None
+      try:
+        network_instance = agent.Handle_Notification( Config(data) )
+        if network_instance:
+          agent.ConfigureBGPPeering( network_instance )
+      except Exception as e:
+        failed = f"reconcile failed: {e}"
+      row = { 'peers': peers, 'prefixes': per_as * peers, 'phase': name, 'failed': failed,
+              'seconds': time.monotonic() - t0,
+              'changed': agent.reconcilers['default'].changed,
+              'gnmi_calls': { k: v - calls0.get(k, 0) for k, v in stats.calls.items()
+                              if v - calls0.get(k, 0) },
+              'gnmi_bytes': stats.bytes - bytes0,
+              'http_requests': HttpStats.requests - http0,
+              'http_bytes': HttpStats.bytes - hbytes0 }
+      return row
+
+    config = { 'IXP': { 'value': IX },
+               'peer_as': [ { 'value': str(a) } for a in asns[:peers] ] }
+    check_order(agent)
+    cold = run( 'cold', config )
+    if not cold['failed'] and not (cold['changed'] and cold['gnmi_calls'].get('Set')):
+      cold['failed'] = ( f"changed {cold['changed']} objects in "
+                         f"{cold['gnmi_calls'].get('Set',0)} Set calls" )
+    results.put( cold )
+    if cold['failed']:
+      raise RuntimeError( "cold reconcile failed, later phases would be meaningless" )
+    results.put( run( 'warm', config ) )
+    results.put( run( 'add-one', dict( config, peer_as=[ { 'value': str(a) } for a in asns ] ) ) )
+
+    # Neighbor event path: the subscription replays all neighbors
+    neighbors = sum( 1 for p in tree.objects if p and p[-1][0] == 'neighbor' )
+    if not neighbors:
+      raise RuntimeError( "no neighbors configured, cannot time the neighbor event path" )
+    calls0, bytes0 = dict(stats.calls), stats.bytes
+    t0 = time.monotonic()
+    def coalescer():
+      asyncio.set_event_loop( asyncio.new_event_loop() )
+      asyncio.get_event_loop().run_until_complete( agent.neighbor_events.run(agent.gnmi_connection) )
+    threading.Thread( target=coalescer, daemon=True ).start()
+    threading.Thread( target=agent.Gnmi_subscribe_bgp_changes, daemon=True ).start()
+    deadline = t0 + 300
+    while acl_entries(tree) < 2 * neighbors and time.monotonic() < deadline:
+      time.sleep(0.01)
+    created = acl_entries(tree)
+    results.put( { 'peers': peers, 'prefixes': per_as * peers, 'phase': 'neighbor-events',
+                   'failed': None if created >= 2 * neighbors else
+                             f"timeout: {created} of {2*neighbors} ACL entries",
+                   'seconds': time.monotonic() - t0, 'changed': created,
+                   'gnmi_calls': { k: v - calls0.get(k, 0) for k, v in stats.calls.items()
+                                   if v - calls0.get(k, 0) },
+                   'gnmi_bytes': stats.bytes - bytes0,
+                   'http_requests': 0, 'http_bytes': 0 } )
+
+    results.put( { 'peers': peers, 'phase': 'rss',
+                   'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss } )
+    server.stop(0)
+    httpd.shutdown()
+
+def run_scenario(peers, total_prefixes, results):
+    """
+    Child process entry: an exception ends the run with a failed row
+    """
+    try:
+      scenario(peers, total_prefixes, results)
+    except BaseException as e:
+      results.put( failed_row(peers, 'aborted', f"{type(e).__name__}: {e}") )
+    finally:
+      results.put( None )
+
+def failed_row(peers, phase, reason):
+    return { 'peers': peers, 'prefixes': 0, 'phase': phase, 'failed': reason, 'seconds': 0,
+             'changed': 0, 'gnmi_calls': {}, 'gnmi_bytes': 0, 'http_requests': 0, 'http_bytes': 0 }
+
+def main():
+    parser = argparse.ArgumentParser( description=__doc__.split('\n')[1] )
+    parser.add_argument( '--peers', default='10,100,1000,5000',
+                         help='Comma separated list of peer counts' )
+    parser.add_argument( '--prefixes', type=int, default=100000,
+                         help='Total number of IRR prefixes across all peers' )
+    parser.add_argument( '--json', action='store_true', help='Output raw JSON rows' )
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn') # Fresh process per size, no grpc fork issues
+    failures = 0
+    print( f"{'peers':>6} {'prefixes':>9} {'phase':<16} {'seconds':>8} {'changed':>8} "
+           f"{'gnmi calls':<28} {'gnmi bytes':>11} {'http req':>8} {'http bytes':>11} {'rss MB':>7}" )
+    for peers in [ int(p) for p in args.peers.split(',') ]:
+      results = ctx.Queue()
+      proc = ctx.Process( target=run_scenario, args=(peers, args.prefixes, results) )
+      proc.start()
+      rows, exited = [], False
+      while True:
+        try:
+          row = results.get( timeout=1 )
+        except queue.Empty:
+          if proc.is_alive():
+            continue
+          if exited: # Nothing left in the queue either
+            rows.append( failed_row(peers, 'exit', f"process died (exit code {proc.exitcode})") )
+            break
+          exited = True
+          continue
+        if row is None:
+          break
+        rows.append(row)
+      proc.join()
+      failures += sum( 1 for r in rows if r.get('failed') )
+      rss = next( (r['peak_rss_kb'] for r in rows if r['phase'] == 'rss'), 0 ) / 1024
+      for r in rows:
+        if r['phase'] == 'rss':
+          continue
+        if args.json:
+          print( json.dumps( dict(r, peak_rss_mb=rss) ) )
+          continue
+        calls = ','.join( f"{k}={v}" for k, v in sorted(r['gnmi_calls'].items()) )
+        print( f"{r['peers']:>6} {r['prefixes']:>9} {r['phase']:<16} {r['seconds']:>8.2f} "
+               f"{r['changed']:>8} {calls:<28} {r['gnmi_bytes']:>11} "
+               f"{r['http_requests']:>8} {r['http_bytes']:>11} {rss:>7.1f}"
+               + ( f"  FAILED: {r['failed']}" if r['failed'] else "" ) )
+    if failures:
+      print( f"{failures} phase(s) failed", file=sys.stderr )
+      sys.exit( 1 )
+
+if __name__ == '__main__':
+    main()
@@ -7,28 +7,33 @@ import sys
 import logging
 import socket
 import os
-from ipaddress import ip_network, ip_address, IPv4Address
+from ipaddress import ip_network, ip_address, IPv4Address, IPv6Address
 import json
 import signal
 import traceback
 import re
 import time
-# from concurrent.futures import ThreadPoolExecutor
-from threading import Thread
-
-import sdk_service_pb2
-import sdk_service_pb2_grpc
-import config_service_pb2
-
-# To report state back
-import telemetry_service_pb2
-import telemetry_service_pb2_grpc
-
-from pygnmi.client import gNMIclient, telemetryParser
+import sqlite3
+import heapq
+import random
+import select
+import ctypes
+import asyncio
+import codecs
+import hashlib
+import bisect
+import threading
+from email.utils import parsedate_to_datetime
+from array import array
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from threading import Thread, Lock, Event, local
 from logging.handlers import RotatingFileHandler
+import typing
 
-# PeeringDB integration
-import typing, requests, netns
+# Heavy modules are imported where first needed, to shorten startup:
+# - NDK protobuf stubs (sdk_service_pb2, config_service_pb2, telemetry_service_pb2)
+# - pygnmi, for the gNMI connection
+# - requests and netns, for PeeringDB integration
 # from urllib.parse import quote
 
 ############################################################
@@ -38,40 +43,398 @@ agent_name='ixp_agent'
 
 acl_sequence_start=1000 # Default ACL sequence number base, can be configured
 acl_count=0             # Number of ACL entries created/managed
+acl_mode='per-peer'     # 'per-peer': 2 cpm-filter entries per peer, 'shared': 2 per address family
+shared_acl_list='ixp-agent-bgp-peers' # Prefix-list name (plus -ipv4/-ipv6) used in shared mode
 
-ixp = ""                # IXP site, e.g. "DE-CIX Frankfurt"
-peer_as_list = []       # List of AS to peer with
+fetch_parallelism = 8   # Max concurrent PeeringDB/IRR lookups, can be configured
+http_timeout = 30       # Seconds before a PeeringDB/IRR lookup is abandoned
+
+cache_file = '/etc/opt/srlinux/ixp-agent-cache.sqlite' # Survives agent restarts
+cache_ttl = 3600        # Seconds before cached PeeringDB/IRR data is refreshed
+event_settle_time = 2.0 # Seconds without new events before a neighbor change is applied
+max_set_objects = 2000  # gNMI Set transactions are split beyond this many objects,
+max_set_bytes = 2000000 # or beyond this payload size
+telemetry_interval = 1.0 # Minimum seconds between telemetry updates sent to NDK
+aggregate_prefixes = False # Collapse IRR prefixes into mask-length-range entries
+max_prefix_headroom = 50 # Percent on top of the PeeringDB info_prefixes4/6 count, for the neighbor prefix limit
+max_prefix_warning = 90 # Percent of the prefix limit at which the router logs a warning
+NET_BATCH_SIZE = 100    # AS per PeeringDB /net?asn__in= request, keeps URLs short
+MAX_RECEIVED_ROUTES = 4294967295 # SR Linux default, i.e. no limit
+rpki_vrp_file = ""      # Local VRP export (JSON) to validate IRR prefixes against, empty to disable
+refresh_interval = 3600 # Seconds between background refreshes per AS/IX, 0 to disable
+refresh_rate_limit = 60 # Max background PeeringDB/IRR requests per minute
+metrics_port = 0        # Local port serving metrics as text, 0 to disable
+METRICS_INTERVAL = 10   # Seconds between metrics published as state
+profiler_enabled = False # SIGUSR1 toggles the sampling profiler when enabled
+profiler_interval = 0.01 # Seconds between profiler samples
+profiler_max_duration = 300 # Seconds after which the profiler stops by itself
+profiler_dir = '/var/log/srlinux/stdout' # Where profiles (.folded) are written
 
 ############################################################
 ## Open a GRPC channel to connect to sdk_mgr on the dut
 ## sdk_mgr will be listening on 50053
 ############################################################
-channel = grpc.insecure_channel('unix:///opt/srlinux/var/run/sr_sdk_service_manager:50053')
-# channel = grpc.insecure_channel('127.0.0.1:50053')
+sdk_mgr_address = 'unix:///opt/srlinux/var/run/sr_sdk_service_manager:50053'
+# sdk_mgr_address = '127.0.0.1:50053'
+channel = None          # grpc.aio channel, created on the event loop in Run()
 metadata = [('agent_name', agent_name)]
-stub = sdk_service_pb2_grpc.SdkMgrServiceStub(channel)
+stub = None             # SdkMgrServiceStub, created in Run()
+main_task = None        # Agent_Main(), cancelled on SIGTERM
 
 match_port = { 0: 'source-port', 1: 'destination-port' }
 
+gnmi_target = ('unix:///opt/srlinux/var/run/sr_gnmi_server',57400)
+mgmt_netns = 'srbase-mgmt' # None: stay in the current netns (e.g. for benchmarks)
+mgmt_netns_path = '/var/run/netns/srbase-mgmt'
+peeringdb_api = 'https://peeringdb.com/api'
+irrexplorer_api = 'https://irrexplorer.nlnog.net/api'
+
+############################################################
+## Instrumentation: latency histograms and counts per stage, plus the
+## depths of the event queues. Published as state under ixp-agent
+## (list stage, container queues), and optionally as text (Prometheus
+## exposition format) on a local port. An opt-in sampling profiler,
+## toggled by SIGUSR1, writes folded stacks for flamegraph.pl
+############################################################
+class Histogram:
+  BOUNDS = ( 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+             0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0 ) # Seconds
+
+  def __init__(self):
+    self.buckets = [0] * (len(self.BOUNDS)+1) # Last one is +Inf
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+
+  def observe(self,seconds):
+    self.buckets[ bisect.bisect_left(self.BOUNDS,seconds) ] += 1
+    self.count += 1
+    self.sum += seconds
+    self.max = max( self.max, seconds )
+
+  def quantile(self,q):
+    """
+    Upper bound of the bucket holding quantile q, in seconds
+    """
+    rank, seen = q * self.count, 0
+    for i,n in enumerate(self.buckets):
+      seen += n
+      if n and seen >= rank:
+        return self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+    return 0.0
+
+class Metrics:
+  STAGES = ( 'netns-entry', 'peeringdb-fetch', 'irr-fetch', 'prefix-set',
+             'gnmi-get', 'gnmi-set', 'acl-lookup', 'telemetry-publish' )
+
+  def __init__(self):
+    self.lock = Lock()
+    self.stages = { s: Histogram() for s in self.STAGES }
+    self.queues = {}  # name -> callable returning the current depth
+
+  def observe(self,stage,seconds):
+    with self.lock:
+      self.stages[stage].observe( seconds )
+
+  def timed(self,stage):
+    return _Timed(self,stage)
+
+  def queue(self,name,depth):
+    self.queues[name] = depth
+
+  def snapshot(self):
+    with self.lock:
+      stages = { s: ( h.count, h.sum, h.max, list(h.buckets),
+                      h.quantile(0.5), h.quantile(0.9), h.quantile(0.99) )
+                 for s,h in self.stages.items() }
+    queues = {}
+    for name,depth in self.queues.items():
+      try:
+        queues[name] = int( depth() )
+      except Exception:
+        queues[name] = 0
+    return stages, queues
+
+  def publish(self):
+    stages, queues = self.snapshot()
+    for s,(count,total,mx,_,p50,p90,p99) in stages.items():
+      telemetry.update( '.ixp_agent.stage{.name=="' + s + '"}',
+        count=count, total_time=int(total*1e6), max_time=int(mx*1e6),
+        p50=int(p50*1e6), p90=int(p90*1e6), p99=int(p99*1e6) )
+    telemetry.update( '.ixp_agent.queues', **{ k.replace('-','_'): v for k,v in queues.items() } )
+
+  def text(self):
+    stages, queues = self.snapshot()
+    lines = [ '# TYPE ixp_agent_stage_seconds histogram' ]
+    for s,(count,total,_,buckets,_,_,_) in stages.items():
+      cumulative = 0
+      for bound,n in zip( Histogram.BOUNDS + ('+Inf',), buckets ):
+        cumulative += n
+        lines.append( f'ixp_agent_stage_seconds_bucket{{stage="{s}",le="{bound}"}} {cumulative}' )
+      lines.append( f'ixp_agent_stage_seconds_sum{{stage="{s}"}} {total:.6f}' )
+      lines.append( f'ixp_agent_stage_seconds_count{{stage="{s}"}} {count}' )
+    lines.append( '# TYPE ixp_agent_queue_depth gauge' )
+    for name,depth in queues.items():
+      lines.append( f'ixp_agent_queue_depth{{queue="{name}"}} {depth}' )
+    return '\n'.join(lines) + '\n'
+
+  async def _serve(self,reader,writer):
+    try:
+      await asyncio.wait_for( reader.readline(), 5 ) # Any request gets the metrics
+      body = self.text().encode()
+      writer.write( b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                    b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body )
+      await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+      pass
+    finally:
+      writer.close()
+
+  async def run(self):
+    """
+    Publishes the metrics every METRICS_INTERVAL, and (re)starts the local
+    text endpoint when metrics_port is changed
+    """
+    server, port = None, 0
+    while True:
+      if metrics_port != port:
+        if server is not None:
+          server.close()
+          await server.wait_closed()
+          server = None
+        port = metrics_port
+        if port:
+          try:
+            server = await asyncio.start_server( self._serve, '127.0.0.1', port )
+            logging.info( f"Metrics endpoint listening on 127.0.0.1:{port}" )
+          except OSError as e:
+            logging.error( f"Cannot listen on metrics port {port}: {e}" )
+      self.publish()
+      await asyncio.sleep( METRICS_INTERVAL )
+
+class _Timed:
+  __slots__ = ('metrics','stage','t0')
+
+  def __init__(self,metrics,stage):
+    self.metrics, self.stage = metrics, stage
+
+  def __enter__(self):
+    self.t0 = time.perf_counter()
+
+  def __exit__(self,*exc):
+    self.metrics.observe( self.stage, time.perf_counter()-self.t0 )
+
+metrics = Metrics()
+
+class SamplingProfiler:
+  """
+  Samples the stacks of all threads every profiler_interval while active,
+  and writes them in folded format (flamegraph.pl, speedscope) when
+  stopped. Only available when profiler-enabled is configured
+  """
+  def __init__(self):
+    self.lock = Lock()
+    self.active = None      # Event that stops the sampling thread
+
+  def toggle(self):
+    if not profiler_enabled:
+      logging.info( "Profiler signal ignored, profiler-enabled is false" )
+      return
+    with self.lock:
+      if self.active is None:
+        self.active = Event()
+        Thread( target=self._sample, args=(self.active,), name='profiler', daemon=True ).start()
+        logging.info( "Profiler started, signal again to stop and write the profile" )
+      else:
+        self.active.set()
+        self.active = None
+
+  def _sample(self,stop):
+    stacks, samples = {}, 0
+    me = threading.get_ident()
+    names = {}
+    deadline = time.monotonic() + profiler_max_duration
+    while not stop.wait( profiler_interval ) and time.monotonic() < deadline:
+      for t in threading.enumerate():
+        names[t.ident] = t.name
+      for ident,frame in sys._current_frames().items():
+        if ident == me:
+          continue
+        stack = []
+        while frame is not None:
+          code = frame.f_code
+          stack.append( f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})" )
+          frame = frame.f_back
+        stack.append( names.get(ident,str(ident)) )
+        key = ';'.join( reversed(stack) )
+        stacks[key] = stacks.get(key,0) + 1
+      samples += 1
+    with self.lock:
+      if self.active is stop: # Stopped by the deadline
+        self.active = None
+    filename = os.path.join( profiler_dir,
+                             f"{agent_name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded" )
+    try:
+      with open(filename,'w') as f:
+        for key,n in sorted( stacks.items() ):
+          f.write( f"{key} {n}\n" )
+      logging.info( f"Profiler: {samples} samples written to {filename}" )
+    except OSError as e:
+      logging.error( f"Profiler: cannot write {filename}: {e}" )
+
+profiler = SamplingProfiler()
+
+############################################################
+## Startup readiness: instead of a fixed delay, each dependency is
+## awaited (with a bounded timeout) and the time per phase is logged
+############################################################
+start_time = time.monotonic()
+startup_done = Event()  # Set once all readiness phases completed (or timed out)
+first_reconcile = True
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+def _inotify():
+    """
+    Returns (libc, fd) for a new non-blocking inotify instance, raises
+    OSError or AttributeError when inotify is not available
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.inotify_init1( os.O_NONBLOCK | os.O_CLOEXEC )
+    if fd < 0:
+      raise OSError( ctypes.get_errno(), "inotify_init1" )
+    return libc, fd
+
+def wait_for_path(path, timeout, mask=IN_CREATE|IN_MOVED_TO):
+    """
+    Waits until 'path' exists, using inotify on the nearest existing parent
+    directory. Falls back to polling when inotify is not available
+    """
+    deadline = time.monotonic() + timeout
+    try:
+      libc, fd = _inotify()
+    except (OSError, AttributeError) as e:
+      logging.info( f"wait_for_path: no inotify ({e}), polling for {path}" )
+      while not os.path.exists(path) and time.monotonic() < deadline:
+        time.sleep( 0.2 )
+      return os.path.exists(path)
+    try:
+      watched = set()
+      while True:
+        # Watch before checking, such that no event can be missed
+        parent = os.path.dirname(path)
+        while parent != '/' and not os.path.isdir(parent):
+          parent = os.path.dirname(parent)
+        if parent not in watched:
+          libc.inotify_add_watch( fd, parent.encode(), mask | IN_CREATE )
+          watched.add( parent )
+        if os.path.exists(path):
+          return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          return False
+        if select.select( [fd], [], [], remaining )[0]:
+          os.read( fd, 4096 ) # Only used as wakeup, re-check the path
+    finally:
+      os.close( fd )
+
+def wait_for_change(path, timeout):
+    """
+    Waits until a file in the directory of 'path' is written, (re)created,
+    renamed into place or deleted, or until timeout. Callers compare file
+    stats to find out whether 'path' itself changed
+    """
+    parent = os.path.dirname(path) if path else ''
+    try:
+      if not os.path.isdir(parent):
+        raise OSError( "no directory to watch" )
+      libc, fd = _inotify()
+    except (OSError, AttributeError):
+      time.sleep( timeout )
+      return
+    try:
+      libc.inotify_add_watch( fd, parent.encode(),
+                              IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE )
+      if select.select( [fd], [], [], timeout )[0]:
+        time.sleep( 0.1 ) # Let a burst of events (e.g. write + rename) settle
+    finally:
+      os.close( fd )
+
+def probe_unix_socket(path, timeout):
+    """
+    Waits until a server accepts connections on the given unix socket
+    """
+    deadline = time.monotonic() + timeout
+    while wait_for_path(path, max(deadline - time.monotonic(),0)):
+      try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+          sock.settimeout( max(deadline - time.monotonic(),0.1) )
+          sock.connect( path )
+          return True
+      except OSError:
+        if time.monotonic() >= deadline:
+          break
+        time.sleep( 0.1 )
+    return False
+
+def _resolve(host):
+    _enter_mgmt_netns()
+    return socket.getaddrinfo( host, 443, proto=socket.IPPROTO_TCP )
+
+def probe_dns(host, timeout):
+    """
+    Resolves 'host' from the mgmt netns (on a fetch worker), bounded by timeout
+    """
+    try:
+      fetch_pool().submit( _resolve, host ).result( timeout=timeout )
+      return True
+    except Exception as e:
+      logging.info( f"DNS probe for {host} failed: {e}" )
+      return False
+
+def Startup_Readiness():
+    """
+    Runs the readiness phases in the background, while the agent is already
+    registered and waiting for config
+    """
+    phases = [ ('mgmt-netns', lambda: wait_for_path(mgmt_netns_path, timeout=60)),
+               ('gnmi-socket', lambda: probe_unix_socket(gnmi_target[0][len('unix://'):], timeout=30)),
+               ('dns', lambda: probe_dns('peeringdb.com', timeout=10)) ]
+    for name, check in phases:
+      t0 = time.monotonic()
+      ok = check()
+      logging.info( f"Startup phase {name}: {'ready' if ok else 'TIMEOUT'} after "
+                    f"{(time.monotonic()-t0)*1000:.0f} ms" )
+    logging.info( f"Startup readiness completed {time.monotonic()-start_time:.2f}s after start" )
+    startup_done.set()
+
 ############################################################
 ## Subscribe to required event
 ## This proc handles subscription of: Interface, LLDP,
 ##                      Route, Network Instance, Config
 ############################################################
-def Subscribe(stream_id, option):
+async def Subscribe(stream_id, option):
+    import sdk_service_pb2, config_service_pb2
     op = sdk_service_pb2.NotificationRegisterRequest.AddSubscription
     if option == 'cfg':
         entry = config_service_pb2.ConfigSubscriptionRequest()
         entry.key.js_path = '.' + agent_name # filter out .commit.end notifications
         request = sdk_service_pb2.NotificationRegisterRequest(op=op, stream_id=stream_id, config=entry)
+    elif option == 'cfg-network-instance':
+        entry = config_service_pb2.ConfigSubscriptionRequest()
+        entry.key.js_path = '.network_instance.' + agent_name
+        request = sdk_service_pb2.NotificationRegisterRequest(op=op, stream_id=stream_id, config=entry)
 
-    subscription_response = stub.NotificationRegister(request=request, metadata=metadata)
-    print('Status of subscription response for {}:: {}'.format(option, subscription_response.status))
+    subscription_response = await stub.NotificationRegister(request=request, metadata=metadata)
+    logging.info('Status of subscription response for {}:: {}'.format(option, subscription_response.status))
 
 ############################################################
 ## Subscribe to all the events that Agent needs
 ############################################################
-def Subscribe_Notifications(stream_id):
+async def Subscribe_Notifications(stream_id):
     '''
     Agent will receive notifications to what is subscribed here.
     '''
@@ -80,50 +443,965 @@ def Subscribe_Notifications(stream_id):
         return False
 
     # Subscribe to config changes, first
-    Subscribe(stream_id, 'cfg')
+    await Subscribe(stream_id, 'cfg')
+    await Subscribe(stream_id, 'cfg-network-instance')
+
+############################################################
+## Long-lived gNMI client, shared by the config (reconcile) path and
+## the BGP neighbor subscription. When the channel breaks (e.g. after
+## a gnmi_server restart) it reconnects with exponential backoff and
+## jitter; subscriptions are reissued and resynced after a reconnect
+############################################################
+def _unavailable(e):
+    """
+    True for errors that mean the channel is gone, as opposed to errors
+    returned by the server. pygnmi wraps grpc errors in its own exceptions
+    """
+    while e is not None:
+      if isinstance(e,grpc.FutureTimeoutError):
+        return True
+      if isinstance(e,grpc.RpcError) and hasattr(e,'code'):
+        return e.code() in (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.CANCELLED)
+      e = getattr(e,'orig_exc',None) or e.__cause__ or e.__context__
+    return False
+
+class GnmiConnection:
+  def __init__(self,target):
+    self.target = target
+    self.lock = Lock()
+    self.client = None
+    self.generation = 0   # Incremented on every (re)connect
+    self.stats = { 'connects': 0, 'connect_time': 0.0,
+                   'rpcs': 0, 'rpc_errors': 0, 'rpc_time': 0.0 }
+
+  def _connect(self):
+    delay = 0.5
+    while True:
+      t0 = time.monotonic()
+      try:
+        from pygnmi.client import gNMIclient
+        c = gNMIclient(target=self.target, username="admin",password="NokiaSrl1!",
+                       insecure=True, debug=False)
+        c.connect()
+        self.stats['connects'] += 1
+        self.stats['connect_time'] += time.monotonic()-t0
+        self.client = c
+        self.generation += 1
+        logging.info( f"gNMI connected ({self.generation}) in {(time.monotonic()-t0)*1000:.0f} ms" )
+        return
+      except Exception as e:
+        logging.error( f"gNMI connect failed, retry in {delay:.1f}s: {e}" )
+        time.sleep( delay * random.uniform(0.5,1.5) )
+        delay = min( delay*2, 30 )
+
+  def connection(self):
+    """
+    Returns the current client and its generation, connecting if needed
+    """
+    with self.lock:
+      if self.client is None:
+        self._connect()
+      return self.client, self.generation
+
+  def reset(self,generation):
+    """
+    Drops a broken client, unless another thread already reconnected
+    """
+    with self.lock:
+      if self.client is not None and self.generation == generation:
+        try:
+          self.client.close()
+        except Exception:
+          pass
+        self.client = None
+
+  def _rpc(self,name,**kwargs):
+    for attempt in (1,2):
+      c, gen = self.connection()
+      t0 = time.monotonic()
+      try:
+        return getattr(c,name)(**kwargs)
+      except Exception as e:
+        self.stats['rpc_errors'] += 1
+        if attempt == 2 or not _unavailable(e):
+          raise
+        logging.error( f"gNMI {name} failed, reconnecting: {e}" )
+        self.reset(gen)
+      finally:
+        self.stats['rpcs'] += 1
+        self.stats['rpc_time'] += time.monotonic()-t0
+        metrics.observe( 'gnmi-'+name, time.monotonic()-t0 )
+
+  def get(self,**kwargs):
+    return self._rpc('get',**kwargs)
+
+  def set(self,**kwargs):
+    return self._rpc('set',**kwargs) # Idempotent, safe to retry
+
+  def subscribe_forever(self,subscribe,on_message,on_connect):
+    """
+    Runs the subscription, reissuing it after every reconnect. on_connect
+    is called first on each new connection, to resync missed state
+    """
+    delay = 0.5
+    while True:
+      c, gen = self.connection()
+      try:
+        on_connect(self)
+        delay = 0.5
+        for m in c.subscribe(subscribe=subscribe):
+          on_message(m)
+        logging.info( "gNMI subscription ended" )
+      except Exception as e:
+        logging.error( f"gNMI subscription failed, resubscribe in {delay:.1f}s: {e}" )
+        time.sleep( delay * random.uniform(0.5,1.5) )
+        delay = min( delay*2, 30 )
+      self.reset(gen)
+
+  def counters(self):
+    st = self.stats
+    return { 'connects': st['connects'],
+             'connect_time_ms': int( st['connect_time']*1000 / max(st['connects'],1) ),
+             'rpcs': st['rpcs'], 'rpc_errors': st['rpc_errors'],
+             'rpc_time_ms': int( st['rpc_time']*1000 / max(st['rpcs'],1) ) }
+
+gnmi_connection = GnmiConnection(gnmi_target)
+
+############################################################
+## Fetch stage: PeeringDB/IRR lookups run on a bounded pool of
+## worker threads. Each worker moves itself into the mgmt netns
+## once, and all workers share one keep-alive HTTP session, such
+## that DNS/TCP/TLS setup is paid once per host instead of per AS
+############################################################
+_fetch_pool = None
+_http = None
+_pool_size = 0          # fetch_parallelism used to size the pool and session
+_fetch_lock = Lock()    # Pool and session are created once, by one thread
+_worker = local()
+
+def fetch_pool():
+  """
+  When fetch_parallelism changes, a new pool (and session) replaces the old
+  one. The old pool is not shut down, as reconciles and refreshes may still
+  submit to it: its workers finish and exit once it is no longer referenced
+  """
+  global _fetch_pool, _http, _pool_size
+  with _fetch_lock:
+    if _fetch_pool is None or _pool_size != fetch_parallelism:
+      _fetch_pool = ThreadPoolExecutor(max_workers=fetch_parallelism,
+                                       thread_name_prefix='fetch')
+      _http = None
+      _pool_size = fetch_parallelism
+    return _fetch_pool
+
+def http_session():
+  global _http
+  with _fetch_lock:
+    if _http is None:
+      import requests
+      from requests.adapters import HTTPAdapter
+      _http = requests.Session()
+      # One pool per host (peeringdb, irrexplorer), sized for all workers
+      adapter = HTTPAdapter(pool_connections=4, pool_maxsize=fetch_parallelism)
+      _http.mount('https://', adapter)
+      _http.mount('http://', adapter)
+    return _http
+
+def _enter_mgmt_netns():
+  """
+  Moves the calling fetch worker thread into the srbase-mgmt netns (once).
+  setns() only affects the calling thread, the main thread stays put
+  """
+  if mgmt_netns is None or getattr(_worker, 'in_netns', False):
+    return
+  import netns
+  with metrics.timed('netns-entry'):
+    while not wait_for_path(mgmt_netns_path, timeout=60):
+      logging.info("Waiting for srbase-mgmt netns to be created...")
+    with open(netns.get_ns_path(nsname=mgmt_netns)) as fd:
+      netns.setns(fd, netns.CLONE_NEWNET)
+  _worker.in_netns = True
+
+############################################################
+## Streaming JSON parsing and compact prefix storage: responses are
+## read in chunks and the objects of the top-level array are decoded
+## one at a time, keeping only the fields the agent needs. Memory is
+## bounded by one chunk plus one object rather than the whole response
+############################################################
+JSON_CHUNK_SIZE = 65536
+JSON_MAX_OBJECT = 1 << 20 # Larger (incomplete) array elements are treated as malformed
+
+def iter_json_array(chunks, key: str, stats: dict = None):
+  """
+  Yields the objects in the top-level array 'key' of a JSON document read
+  as an iterable of byte chunks, e.g. resp.iter_content() of a streamed
+  (stream=True) response. If given, stats['peak'] records the peak buffer size
+  """
+  decoder = json.JSONDecoder()
+  utf8 = codecs.getincrementaldecoder('utf-8')()
+  chunks = iter(chunks)
+  buf, pos, peak = '', 0, 0
+
+  def more():
+    nonlocal buf, pos, peak
+    for chunk in chunks:
+      if chunk:
+        buf = buf[pos:] + utf8.decode(chunk)
+        pos = 0
+        peak = max( peak, len(buf) )
+        return True
+    return False
+
+  def skip(chars):
+    nonlocal pos
+    while True:
+      while pos < len(buf) and buf[pos] in chars:
+        pos += 1
+      if pos < len(buf) or not more():
+        return
+
+  marker = re.compile( '"' + re.escape(key) + r'"\s*:\s*\[' )
+  while True:
+    m = marker.search( buf, pos )
+    if m:
+      pos = m.end()
+      break
+    pos = max( pos, len(buf) - len(key) - 64 ) # Keep a tail in case the key is split
+    if not more():
+      raise ValueError( f"No '{key}' array in response" )
+  try:
+    while True:
+      skip( ' \t\r\n,' )
+      if pos >= len(buf):
+        raise ValueError( f"Truncated '{key}' array in response" )
+      if buf[pos] == ']':
+        return
+      try:
+        obj, end = decoder.raw_decode( buf, pos )
+      except ValueError:
+        if len(buf) - pos > JSON_MAX_OBJECT or not more():
+          raise
+        continue
+      pos = end
+      yield obj
+  finally:
+    if stats is not None:
+      stats['peak'] = max( stats.get('peak',0), peak )
+
+def parse_prefix(prefix: str):
+  """
+  Returns (IP version, network as int, length) for a prefix string; host
+  bits are cleared. Raises ValueError or OSError when invalid
+  """
+  addr, _, plen = prefix.strip().partition('/')
+  v, af, width = (6, socket.AF_INET6, 128) if ':' in addr else (4, socket.AF_INET, 32)
+  plen = int(plen) if plen else width
+  if not 0 <= plen <= width:
+    raise ValueError( f"invalid prefix length in {prefix}" )
+  net = int.from_bytes( socket.inet_pton(af,addr), 'big' )
+  return v, net & (((1 << plen) - 1) << (width-plen)), plen
+
+class PrefixList:
+  """
+  Compact per-AS prefix list: IPv4 as packed ints (network << 8 | length) in
+  an array, IPv6 as 17-byte (network, length) records in a bytearray
+  """
+  __slots__ = ('v4','v6','peak')
+
+  def __init__(self):
+    self.v4 = array('Q')
+    self.v6 = bytearray()
+    self.peak = 0 # Peak memory (bytes) used to build this list
+
+  def add(self, prefix: str):
+    self.append( *parse_prefix(prefix) )
+
+  def append(self, v: int, net: int, plen: int):
+    if v == 4:
+      self.v4.append( net << 8 | plen )
+    else:
+      self.v6 += net.to_bytes(16,'big') + bytes((plen,))
+
+  def prefixes(self, v: int):
+    """ Yields (network as int, length) for IP version v """
+    if v == 4:
+      for p in self.v4:
+        yield (p >> 8, p & 0xff)
+    else:
+      for i in range(0,len(self.v6),17):
+        yield (int.from_bytes(self.v6[i:i+16],'big'), self.v6[i+16])
+
+  def strings(self, v: int):
+    addr = IPv4Address if v == 4 else IPv6Address
+    return [ f"{addr(net)}/{plen}" for net,plen in self.prefixes(v) ]
+
+  def count(self, v: int):
+    return len(self.v4) if v == 4 else len(self.v6) // 17
+
+  def __len__(self):
+    return self.count(4) + self.count(6)
+
+  def digest(self):
+    """ Content hash, independent of the order in which prefixes were added """
+    h = hashlib.sha256( array('Q',sorted(self.v4)).tobytes() )
+    h.update( b''.join( sorted( bytes(self.v6[i:i+17]) for i in range(0,len(self.v6),17) ) ) )
+    return h.digest()
+
+  @property
+  def nbytes(self):
+    return len(self.v4) * self.v4.itemsize + len(self.v6)
+
+  def to_bytes(self):
+    return len(self.v4).to_bytes(4,'big') + self.v4.tobytes() + bytes(self.v6)
+
+  @classmethod
+  def from_bytes(cls, blob: bytes):
+    pl = cls()
+    n = int.from_bytes( blob[:4], 'big' ) * pl.v4.itemsize
+    pl.v4.frombytes( blob[4:4+n] )
+    pl.v6 = bytearray( blob[4+n:] )
+    pl.peak = len(blob)
+    return pl
+
+class SingleFlight:
+  """
+  Concurrent calls with the same key share one execution and its result,
+  e.g. when an AS appears in multiple network-instances that reconcile
+  in parallel
+  """
+  def __init__(self):
+    self.lock = Lock()
+    self.calls = {}   # key -> Future of the call in progress
+
+  def do(self, key, fn, *args):
+    with self.lock:
+      f = self.calls.get(key)
+      leader = f is None
+      if leader:
+        f = self.calls[key] = Future()
+    if leader:
+      try:
+        f.set_result( fn(*args) )
+      except Exception as e:
+        f.set_exception( e )
+      finally:
+        with self.lock:
+          del self.calls[key]
+    return f.result()
+
+single_flight = SingleFlight()
+metrics.queue( 'fetches-in-flight', lambda: len(single_flight.calls) )
+
+############################################################
+## Persistent PeeringDB/IRR cache (SQLite)
+## - netixlan: the full netixlan set per IX, indexed by (asn, ix)
+## - ix_sync:  when the netixlan set for an IX was last synced
+## - irr:      registered prefixes per AS
+## - net:      prefix counts (info_prefixes4/6) per AS
+############################################################
+class PeeringCache:
+  def __init__(self, filename):
+    try:
+      self.db = sqlite3.connect(filename, check_same_thread=False)
+    except sqlite3.Error as e:
+      logging.error( f"Cannot open cache {filename}, using in-memory: {e}" )
+      self.db = sqlite3.connect(':memory:', check_same_thread=False)
+    self.lock = Lock()
+    with self.lock, self.db:
+      self.db.executescript( """
+        CREATE TABLE IF NOT EXISTS netixlan (
+          id INTEGER PRIMARY KEY, asn INTEGER, ix TEXT,
+          name TEXT, ipaddr4 TEXT, ipaddr6 TEXT );
+        CREATE INDEX IF NOT EXISTS netixlan_asn_ix ON netixlan (asn, ix);
+        CREATE TABLE IF NOT EXISTS ix_sync ( ix TEXT PRIMARY KEY, synced REAL );
+        CREATE TABLE IF NOT EXISTS irr (
+          asn INTEGER PRIMARY KEY, prefixes BLOB, fetched REAL );
+        CREATE TABLE IF NOT EXISTS net (
+          asn INTEGER PRIMARY KEY, prefixes4 INTEGER, prefixes6 INTEGER, fetched REAL );
+      """ )
+
+  def ix_synced(self, ix: str):
+    with self.lock:
+      row = self.db.execute( "SELECT synced FROM ix_sync WHERE ix=?", (ix,) ).fetchone()
+    return row[0] if row else None
+
+  def store_netixlan(self, ix: str, rows, synced: float, full: bool):
+    """
+    Stores (updated) netixlan rows (id,asn,name,ipaddr4,ipaddr6,deleted) for
+    the given IX. A full sync replaces all rows, an incremental one (since=)
+    applies changes and deletions
+    """
+    with self.lock, self.db:
+      if full:
+        self.db.execute( "DELETE FROM netixlan WHERE ix=?", (ix,) )
+      self.db.executemany( "DELETE FROM netixlan WHERE id=?",
+                           ( (r[0],) for r in rows if r[5] ) )
+      self.db.executemany( "INSERT OR REPLACE INTO netixlan VALUES (?,?,?,?,?,?)",
+                           ( (r[0],r[1],ix)+r[2:5] for r in rows if not r[5] ) )
+      self.db.execute( "INSERT OR REPLACE INTO ix_sync VALUES (?,?)", (ix,synced) )
+
+  def netixlan(self, asn: int, ix: str):
+    with self.lock:
+      return self.db.execute( "SELECT name,ipaddr4,ipaddr6 FROM netixlan "
+                              "WHERE asn=? AND ix=? ORDER BY id LIMIT 1",
+                              (asn,ix) ).fetchone()
+
+  def irr(self, asn: int, max_age: float):
+    with self.lock:
+      row = self.db.execute( "SELECT prefixes FROM irr WHERE asn=? AND fetched>?",
+                             (asn,time.time()-max_age) ).fetchone()
+    return PrefixList.from_bytes(row[0]) if row else None
+
+  def store_irr(self, asn: int, prefixes: PrefixList):
+    with self.lock, self.db:
+      self.db.execute( "INSERT OR REPLACE INTO irr VALUES (?,?,?)",
+                       (asn,prefixes.to_bytes(),time.time()) )
+
+  def net(self, asn: int):
+    with self.lock:
+      row = self.db.execute( "SELECT prefixes4,prefixes6 FROM net WHERE asn=?", (asn,) ).fetchone()
+    return tuple(row) if row else (None,None)
+
+  def stale_nets(self, asns, max_age: float):
+    """
+    Returns the AS among asns without a net record fetched in the last max_age seconds
+    """
+    with self.lock:
+      fresh = { r[0] for r in self.db.execute( "SELECT asn FROM net WHERE fetched>?",
+                                               (time.time()-max_age,) ) }
+    return [ asn for asn in asns if asn not in fresh ]
+
+  def store_net(self, asns, rows):
+    """
+    Stores (asn,prefixes4,prefixes6) rows; AS in asns without a row (no net
+    object in PeeringDB) are stored with unknown counts, so are not refetched
+    """
+    found = { r[0]: tuple(r) for r in rows }
+    now = time.time()
+    with self.lock, self.db:
+      self.db.executemany( "INSERT OR REPLACE INTO net VALUES (?,?,?,?)",
+                           ( found.get(asn,(asn,None,None)) + (now,) for asn in asns ) )
+
+_cache = None
+
+def peering_cache():
+  global _cache
+  if _cache is None:
+    _cache = PeeringCache(cache_file)
+  return _cache
+
+def refresh_peeringdb(ix: str, force: bool = False):
+  """
+  Syncs the netixlan set for the whole IX in one request: a full fetch when
+  the IX is not cached yet, an incremental one (since=) once the TTL expires
+  (or when forced), and nothing at all while the cached data is still fresh
+  Must be called from a fetch worker thread
+  """
+  synced = peering_cache().ix_synced(ix)
+  now = time.time()
+  if not force and synced is not None and now - synced < cache_ttl:
+    return
+  _enter_mgmt_netns()
+  url = f"{peeringdb_api}/netixlan?name__contains={ix.replace(' ','%20')}"
+  if synced is not None:
+    url += f"&since={int(synced)-60}" # Some margin for clock differences
+  logging.info( f"PeeringDB query: {url}" )
+  with metrics.timed('peeringdb-fetch'), \
+       http_session().get(url=url, timeout=http_timeout, stream=True) as resp:
+    resp.raise_for_status()
+    rows = [ (r['id'], r.get('asn'), r.get('name'), r.get('ipaddr4'),
+              r.get('ipaddr6'), r.get('status','ok') == 'deleted')
+             for r in iter_json_array(resp.iter_content(JSON_CHUNK_SIZE),'data') ]
+  logging.info( f"PeeringDB: {len(rows)} netixlan objects for {ix}" )
+  peering_cache().store_netixlan( ix, rows, now, full=(synced is None) )
+
+def refresh_net(asns, max_age: float = None):
+  """
+  Fetches the PeeringDB net objects (info_prefixes4/6) of the AS that are
+  not cached or older than max_age (default cache_ttl), NET_BATCH_SIZE AS
+  per asn__in= request
+  Must be called from a fetch worker thread
+  """
+  stale = peering_cache().stale_nets( sorted(set(asns)), cache_ttl if max_age is None else max_age )
+  if not stale:
+    return
+  _enter_mgmt_netns()
+  for i in range(0,len(stale),NET_BATCH_SIZE):
+    batch = stale[i:i+NET_BATCH_SIZE]
+    url = ( f"{peeringdb_api}/net?asn__in={','.join(map(str,batch))}"
+            "&fields=asn,info_prefixes4,info_prefixes6" )
+    logging.info( f"PeeringDB query: {url}" )
+    with metrics.timed('peeringdb-fetch'), \
+         http_session().get(url=url, timeout=http_timeout, stream=True) as resp:
+      resp.raise_for_status()
+      rows = [ (r['asn'], r.get('info_prefixes4'), r.get('info_prefixes6'))
+               for r in iter_json_array(resp.iter_content(JSON_CHUNK_SIZE),'data') ]
+    logging.info( f"PeeringDB: {len(rows)} net objects for {len(batch)} AS" )
+    peering_cache().store_net( batch, rows )
+
+def max_prefix_limit(count):
+  """
+  Returns the max-received-routes for a peer with 'count' prefixes in PeeringDB,
+  plus headroom; MAX_RECEIVED_ROUTES when the count is unknown
+  """
+  if not count:
+    return MAX_RECEIVED_ROUTES
+  return min( (count * (100+max_prefix_headroom) + 99) // 100, MAX_RECEIVED_ROUTES )
 
 """
-Lookup ASN in PeeringDB and return ipv4,ipv6 peering IPs at given IX
+Lookup ASN in the cached PeeringDB netixlan set for the given IX, and return
+the name and ipv4,ipv6 peering IPs. Requires a prior refresh_peeringdb(ix)
 """
 def query_peeringdb(asn: int, ix: str) -> typing.Tuple[typing.Optional[str],typing.Optional[str],typing.Optional[str]]:
-  while not os.path.exists('/var/run/netns/srbase-mgmt'):
-    logging.info("Waiting for srbase-default netns to be created...")
-    time.sleep(2) # 1 second is not enough
-
-  with netns.NetNS(nsname="srbase-mgmt"):
-    url = f"https://peeringdb.com/api/netixlan?asn={asn}&name__contains={ix.replace(' ','%20')}"
-    logging.info( f"PeeringDB query: {url}" )
-    resp = requests.get(url=url)
-  pdb_json = json.loads(resp.text)
-  print( pdb_json )
-  if 'data' in pdb_json and pdb_json['data']:
-    site = pdb_json['data'][0]
-    return ( site['name'], site['ipaddr4'], site['ipaddr6'] )
+  site = peering_cache().netixlan(asn, ix)
+  if site:
+    return tuple(site)
   return ( None, None, None )
 
-def get_prefixlist(asn: int):
+def get_prefixlist(asn: int, max_age: float = None):
+  """
+  Retrieve list of prefixes registered in IRR for the given AS, from cache
+  unless older than max_age (default cache_ttl). The response is parsed as
+  a stream, into a compact PrefixList
+  Must be called from a fetch worker thread
+  """
+  cached = peering_cache().irr(asn, cache_ttl if max_age is None else max_age)
+  if cached is not None:
+    return cached
+  _enter_mgmt_netns()
+  url = f"{irrexplorer_api}/prefixes/asn/AS{asn}"
+  logging.info( f"irrexplorer query: {url}" )
+  pfx, stats = PrefixList(), {}
+  with metrics.timed('irr-fetch'), \
+       http_session().get(url=url, timeout=http_timeout, stream=True) as resp:
+    resp.raise_for_status()
+    # Could use bgpOrigins (AS list) too
+    for i in iter_json_array(resp.iter_content(JSON_CHUNK_SIZE),'overlaps',stats):
+      if i.get("goodnessOverall") == 1:
+        try:
+          pfx.add( i["prefix"] )
+        except (KeyError, ValueError, OSError) as e:
+          logging.warning( f"AS{asn}: skipping invalid IRR prefix {i.get('prefix')}: {e}" )
+  pfx.peak = stats.get('peak',0) + pfx.nbytes
+  peering_cache().store_irr(asn, pfx)
+  return pfx
+
+def lookup_peer(asn: int, ix: str):
   """
-  Retrieve list of prefixes registered in IRR for the given AS
+  Runs on a fetch worker: PeeringDB lookup followed by IRR lookup (only if
+  the AS is present at the IX) and RPKI validation. Returns the results,
+  the PeeringDB prefix counts (requires a prior refresh_net) plus per-lookup
+  timings and the number of RPKI invalid prefixes dropped
   """
-  with netns.NetNS(nsname="srbase-mgmt"):
-    url = f"https://irrexplorer.nlnog.net/api/prefixes/asn/AS{asn}"
-    logging.info( f"irrexplorer query: {url}" )
-    resp = requests.get(url=url)
+  t0 = time.monotonic()
+  name, ip4, ip6 = query_peeringdb( asn, ix )
+  counts = peering_cache().net( asn )
+  t1 = time.monotonic()
+  pfx = single_flight.do( ('irr',asn), get_prefixlist, asn ) if (ip4 or ip6) else PrefixList()
+  t2 = time.monotonic()
+  pfx, invalid = vrp_table.filter( pfx, asn )
+  t3 = time.monotonic()
+  return ( asn, name, ip4, ip6, pfx, counts, { 'peeringdb': t1-t0, 'irr': t2-t1, 'rpki': t3-t2,
+                                       'rpki_invalid': invalid } )
+
+############################################################
+## Background refresh: IRR data per AS and PeeringDB data per IX are
+## refreshed on their own jittered timer, most stale first, within a
+## global budget of requests per minute. HTTP 429/5xx responses pause
+## the API concerned (Retry-After, else exponential backoff). A
+## reconcile is requested only when the content hash changed
+############################################################
+def _retry_after(value):
+  """
+  Parses a Retry-After header (seconds or HTTP date), returns seconds or None
+  """
+  if not value:
+    return None
+  try:
+    return max( float(value), 0 )
+  except ValueError:
+    pass
+  try:
+    return max( parsedate_to_datetime(value).timestamp() - time.time(), 0 )
+  except (TypeError, ValueError):
+    return None
+
+class RefreshScheduler:
+  def __init__(self):
+    self.heap = []          # (due, key), key: ('irr',asn) or ('peeringdb',ix)
+    self.due = {}           # key -> due time of its valid heap entry
+    self.backoff = {}       # key -> seconds, doubled on every failure
+    self.paused = {}        # 'irr'|'peeringdb' -> monotonic time until which the API is avoided
+    self.tokens = 0.0       # Request budget (token bucket)
+    self.refilled = time.monotonic()
+    self.refreshes = 0
+    self.changes = 0
+
+  def _wanted(self):
+    keys = set()
+    for instance in list(reconcilers.values()):
+      if instance.ixp and instance.peer_as_list:
+        keys.add( ('peeringdb',instance.ixp) )
+        keys.update( ('irr',asn) for asn in instance.peer_as_list )
+    return keys
+
+  def _schedule(self,key,due):
+    self.due[key] = due
+    heapq.heappush( self.heap, (due,key) )
+
+  def _sync(self,now):
+    wanted = self._wanted()
+    for key in wanted - self.due.keys():
+      self._schedule( key, now + random.uniform(0,refresh_interval) ) # Staggered
+    for key in self.due.keys() - wanted:
+      del self.due[key]
+      self.backoff.pop( key, None )
+
+  def _next(self):
+    while self.heap:
+      due, key = self.heap[0]
+      if self.due.get(key) == due:
+        return due, key
+      heapq.heappop( self.heap ) # Superseded or no longer wanted
+    return None, None
+
+  def _token(self,now,cost=1):
+    """
+    Takes 'cost' requests from the budget, else returns the seconds until they
+    are available. A cost above the budget is taken once it is full, leaving
+    the budget in debt, such that the average rate still holds
+    """
+    limit = max( refresh_rate_limit, 1 )
+    rate = limit / 60.0
+    self.tokens = min( limit, self.tokens + (now-self.refilled)*rate )
+    self.refilled = now
+    need = min( cost, limit )
+    if self.tokens >= need:
+      self.tokens -= cost
+      return 0
+    return (need-self.tokens) / rate
 
-  pfl_json = json.loads(resp.text)
-  # Could use bgpOrigins (AS list) too
-  return [ i["prefix"] for i in pfl_json["overlaps"] if i["goodnessOverall"]==1 ]
+  @staticmethod
+  def _asns_at(ix):
+    return sorted( { asn for instance in list(reconcilers.values()) if instance.ixp == ix
+                     for asn in instance.peer_as_list } )
 
-def ConfigureBGPPeering():
-    PATH = '/network-instance[name=default]/protocols/bgp'
-    with gNMIclient(target=('unix:///opt/srlinux/var/run/sr_gnmi_server',57400),
-                            username="admin",password="NokiaSrl1!",
-                            insecure=True, debug=False) as gnmi:
+  def _cost(self,key):
+    """
+    HTTP requests done by refresh(key): one for IRR, for PeeringDB one
+    netixlan request plus the /net?asn__in= batches
+    """
+    if key[0] == 'irr':
+      return 1
+    return 1 + -(-len(self._asns_at(key[1])) // NET_BATCH_SIZE)
 
-     def addPeer(_as,name,ip,af,pfx):
+  def refresh(self,key):
+    """
+    Runs on a fetch worker, returns whether the content hash changed
+    """
+    kind, what = key
+    if kind == 'irr':
+      before = peering_cache().irr( what, float('inf') )
+      after = single_flight.do( ('refresh',)+key, get_prefixlist, what, 0 )
+      return (before.digest() if before is not None else None) != after.digest()
+    asns = self._asns_at( what )
+    digest = lambda: hashlib.sha256( repr([ (peering_cache().netixlan(asn,what),
+                                             peering_cache().net(asn))
+                                            for asn in asns ]).encode() ).digest()
+    before = digest()
+    single_flight.do( ('refresh',)+key, refresh_peeringdb, what, True )
+    refresh_net( asns, 0 ) # Prefix counts of the AS at this IX, for their limits
+    return before != digest()
+
+  def _failed(self,key,e,now):
+    """
+    Returns the delay before retrying 'key'; 429 and 5xx pause the whole API
+    """
+    backoff = min( self.backoff.get(key,15) * 2, max(refresh_interval,30) )
+    self.backoff[key] = backoff
+    response = getattr( e, 'response', None )
+    status = getattr( response, 'status_code', None ) or 0
+    if status == 429 or status >= 500:
+      delay = _retry_after( response.headers.get('Retry-After') )
+      delay = backoff if delay is None else delay
+      self.paused[key[0]] = max( self.paused.get(key[0],0), now + delay )
+      logging.warning( f"Refresh {key}: HTTP {status}, pausing {key[0]} for {delay:.0f}s" )
+      return delay
+    logging.warning( f"Refresh {key} failed, retry in {backoff:.0f}s: {e}" )
+    return backoff
+
+  async def run(self):
+    loop = asyncio.get_event_loop()
+    while True:
+      now = time.monotonic()
+      if refresh_interval <= 0: # Disabled
+        self.heap, self.due = [], {}
+        await asyncio.sleep( 10 )
+        continue
+      self._sync(now)
+      due, key = self._next()
+      if key is None or due > now:
+        await asyncio.sleep( min(due-now,10) if key else 10 ) # Recheck config now and then
+        continue
+      if self.paused.get(key[0],0) > now:
+        self._schedule( key, self.paused[key[0]] + random.uniform(0,10) )
+        continue
+      wait = self._token( now, self._cost(key) )
+      if wait:
+        await asyncio.sleep( wait )
+        continue
+      heapq.heappop( self.heap )
+      try:
+        changed = await loop.run_in_executor( fetch_pool(), self.refresh, key )
+        self.backoff.pop( key, None )
+        delay = refresh_interval * random.uniform(0.9,1.1) # Jitter
+      except Exception as e:
+        changed, delay = False, self._failed(key,e,now)
+      self.refreshes += 1
+      if key in self.due:
+        self._schedule( key, time.monotonic() + delay )
+      if changed:
+        self.changes += 1
+        logging.info( f"Refresh {key}: content changed, requesting reconcile" )
+        for name,instance in list(reconcilers.items()):
+          if ( instance.ixp == key[1] if key[0] == 'peeringdb'
+               else key[1] in instance.peer_as_list ):
+            reconcile_scheduler.request(name)
+      Update_State( background_refreshes=self.refreshes, background_refresh_changes=self.changes )
+
+refresh_scheduler = RefreshScheduler()
+metrics.queue( 'refresh-overdue', lambda: sum( 1 for due in list(refresh_scheduler.due.values())
+                                               if due <= time.monotonic() ) )
+
+############################################################
+## RPKI origin validation (RFC 6811) of IRR prefixes against a local
+## VRP export, as produced by rpki-client, routinator or octorpki:
+##   { "roas": [ { "asn": "AS13335", "prefix": "1.0.0.0/24", "maxLength": 24 } ] }
+## VRPs are held in a trie per address family, stored as one dict per
+## prefix length (like aggregate()). When the file changes, only the
+## difference is applied to the trie and the reconcile is re-run
+############################################################
+RPKI_VALID, RPKI_INVALID, RPKI_NOT_FOUND = 'valid', 'invalid', 'not-found'
+
+class VrpTable:
+  _width = { 4: 32, 6: 128 }
+
+  def __init__(self):
+    self.lock = Lock()    # Held to swap in or take the current levels, never for long
+    self.writer = Lock()  # One update at a time
+    self.vrps = set()  # (v, network, length, asn, max length)
+    # Published levels are never modified, an update swaps in changed copies
+    self.levels = { 4: {}, 6: {} } # v -> length -> { network >> (width-length): ((asn,max length),...) }
+    self.lengths = { 4: [], 6: [] } # v -> [(length, shift, level)] ordered by length
+
+  def __len__(self):
+    return len(self.vrps)
+
+  def update(self, vrps: set):
+    """
+    Applies the difference with a new VRP set, returns the number of VRPs
+    added plus removed. Only the levels that change are copied and updated,
+    without the lock; it is held just to swap them in, so a large update
+    (e.g. the initial load) does not block filter()
+    """
+    with self.writer:
+      added, removed = vrps - self.vrps, self.vrps - vrps
+      levels = { v: dict(by_len) for v,by_len in self.levels.items() }
+      copied = set()
+      def level(v,plen):
+        if (v,plen) not in copied:
+          copied.add( (v,plen) )
+          levels[v][plen] = dict( levels[v].get(plen,{}) )
+        return levels[v][plen]
+      for v,net,plen,asn,maxlen in removed:
+        lvl, key = level(v,plen), net >> (self._width[v]-plen)
+        roas = tuple( r for r in lvl[key] if r != (asn,maxlen) )
+        if roas:
+          lvl[key] = roas
+        else:
+          del lvl[key]
+      for v,net,plen,asn,maxlen in added:
+        lvl, key = level(v,plen), net >> (self._width[v]-plen)
+        lvl[key] = lvl.get(key,()) + ((asn,maxlen),)
+      lengths = { v: [ (plen, width-plen, lvl) for plen,lvl in sorted(levels[v].items()) if lvl ]
+                  for v,width in self._width.items() }
+      with self.lock:
+        self.levels, self.lengths, self.vrps = levels, lengths, vrps
+    return len(added) + len(removed)
+
+  def validate(self, v: int, net: int, plen: int, asn: int, lengths=None):
+    """
+    RFC 6811: valid if a covering VRP matches origin AS and max length,
+    invalid if covered but none matches, else not-found. lengths: the
+    levels taken by the caller, default the current ones
+    """
+    covered = False
+    for length,shift,level in (lengths or self.lengths)[v]:
+      if length > plen:
+        break
+      roas = level.get( net >> shift )
+      if roas:
+        covered = True
+        for roa_asn,maxlen in roas:
+          if roa_asn == asn and plen <= maxlen:
+            return RPKI_VALID
+    return RPKI_INVALID if covered else RPKI_NOT_FOUND
+
+  def filter(self, pfx: PrefixList, asn: int):
+    """
+    Returns the prefixes that are not RPKI invalid for origin 'asn', plus
+    the number of invalid prefixes that were dropped
+    """
+    with self.lock: # Consistent levels, even if an update is swapped in meanwhile
+      vrps, lengths = self.vrps, self.lengths
+    if not vrps:
+      return pfx, 0
+    valid = PrefixList()
+    valid.peak = pfx.peak
+    for v in (4,6):
+      for net,plen in pfx.prefixes(v):
+        if self.validate( v, net, plen, asn, lengths ) != RPKI_INVALID:
+          valid.append( v, net, plen )
+    return valid, len(pfx) - len(valid)
+
+vrp_table = VrpTable()
+_vrp_source = None   # (path, file identity) of the loaded VRP set
+_vrp_load_lock = Lock()
+
+def load_vrps(path: str):
+  """
+  Parses a VRP export as a stream, returns a set of (v, network, length,
+  asn, max length). Raises OSError or ValueError if the file is unusable
+  """
+  vrps = set()
+  with open(path,'rb') as f:
+    for roa in iter_json_array( iter(lambda: f.read(JSON_CHUNK_SIZE), b''), 'roas' ):
+      try:
+        asn = roa['asn']
+        if isinstance(asn,str) and asn.upper().startswith('AS'):
+          asn = asn[2:]
+        v, net, plen = parse_prefix( roa['prefix'] )
+        vrps.add( (v, net, plen, int(asn), int(roa.get('maxLength',plen))) )
+      except (KeyError, TypeError, ValueError, OSError) as e:
+        logging.warning( f"Skipping invalid VRP {roa}: {e}" )
+  return vrps
+
+def _file_id(path: str):
+  try:
+    st = os.stat(path)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+  except OSError:
+    return None
+
+def refresh_vrps():
+  """
+  (Re)loads the configured VRP file if it changed since the last load.
+  Returns the number of VRPs added plus removed
+  """
+  global _vrp_source
+  with _vrp_load_lock:
+    path = rpki_vrp_file
+    source = ( path, _file_id(path) if path else None )
+    if source == _vrp_source:
+      return 0
+    t0 = time.monotonic()
+    if source[1] is None:
+      if path:
+        logging.error( f"RPKI VRP file {path} not found, validation disabled" )
+      vrps = set()
+    else:
+      try:
+        vrps = load_vrps(path)
+      except (OSError, ValueError) as e:
+        # E.g. caught while being rewritten in place; retried on the next change
+        logging.error( f"Cannot load RPKI VRP file {path}, keeping previous VRPs: {e}" )
+        return 0
+    _vrp_source = source
+    changes = vrp_table.update( vrps )
+  logging.info( f"RPKI: {len(vrps)} VRPs from '{path}', {changes} changed, "
+                f"in {(time.monotonic()-t0)*1000:.0f} ms" )
+  Update_State( rpki_vrp_count=len(vrps) )
+  return changes
+
+def RPKI_Watcher():
+  """
+  Background thread: reloads the VRP file when it changes (or when another
+  file is configured) and re-runs the reconcile if the VRP set changed
+  """
+  while True:
+    wait_for_change( rpki_vrp_file, timeout=10 )
+    try:
+      if refresh_vrps():
+        for name,instance in list(reconcilers.items()):
+          if instance.ixp and instance.peer_as_list:
+            reconcile_scheduler.request(name)
+    except Exception as e:
+      logging.error( f"RPKI refresh failed: {e}" )
+
+############################################################
+## Prefix aggregation: a binary prefix trie, stored as one dict per
+## prefix length, where each node has a bitmask of the (absolute)
+## lengths at which all its sub-prefixes are present. The topmost
+## node having a length bit emits it, as one 'a..b' mask-length-range
+## per run of bits. The result accepts exactly the same routes
+############################################################
+def aggregate(prefixes, width):
+    """
+    prefixes: iterable of (network as int, length); width: 32 or 128
+    Returns sorted (network as int, length, min length, max length) entries
+    """
+    masks = {}  # length -> { network >> (width-length): mask }
+    for net,plen in prefixes:
+      level = masks.setdefault( plen, {} )
+      key = net >> (width-plen)
+      level[key] = level.get(key,0) | (1 << plen)
+    for plen in range(width,0,-1): # Bottom up: complete if both children are
+      level = masks.get(plen)
+      if not level:
+        continue
+      up = masks.setdefault( plen-1, {} )
+      for key,mask in level.items():
+        if not key & 1:
+          both = mask & level.get(key|1,0)
+          if both:
+            up[key>>1] = up.get(key>>1,0) | both
+    entries = []
+    for plen,level in masks.items():
+      parent = masks.get(plen-1,{})
+      for key,mask in level.items():
+        new = mask & ~parent.get(key>>1,0) if plen else mask
+        while new:
+          low = (new & -new).bit_length() - 1
+          high = low
+          while mask >> (high+1) & 1: # Extend over bits covered by the parent too
+            high += 1
+          entries.append( (key << (width-plen), plen, low, high) )
+          new &= ~((1 << (high+1)) - 1)
+    return sorted( entries )
+
+def prefix_set_entries(pfx,af):
+    """
+    Returns the prefix-set entries for the given address family, aggregated
+    if enabled, plus the number of prefixes before aggregation
+    """
+    v4 = (af == 'ipv4')
+    v, before = (4 if v4 else 6), pfx.count(4 if v4 else 6)
+    if not aggregate_prefixes:
+      return [ { "ip-prefix": p, "mask-length-range": "exact" } for p in pfx.strings(v) ], before
+    out = []
+    for net,plen,low,high in aggregate( pfx.prefixes(v), 32 if v4 else 128 ):
+      out.append( { "ip-prefix": f"{IPv4Address(net) if v4 else IPv6Address(net)}/{plen}",
+                    "mask-length-range": "exact" if low==high==plen else f"{low}..{high}" } )
+    return out, before
+
+def peer_objects(bgp_path,_as,name,ip,af,pfx,count=None):
+      """
+      Returns the desired (path,value) objects for a peer AS in one address family;
+      count: its number of prefixes according to PeeringDB, for the prefix limit
+      """
       group_name = f"ix-{af}"
       policy_name = f"ix-import-{_as}-{af}"
-      updates = [ (f"/routing-policy/policy[name={policy_name}]",
+      objects = [ (f"/routing-policy/policy[name={policy_name}]",
        {
         "default-action": {
           "policy-result": "reject"
@@ -141,13 +1419,13 @@ def ConfigureBGPPeering():
         ]
        }
        ) ]
-      prefixes = []
-      for p in pfx:
-       if ((af=='ipv4' and '.' in p) or (af=='ipv6' and ':' in p)):
-        prefixes.append( { "ip-prefix": p, "mask-length-range": "exact" } )
-      updates.append( (f'/routing-policy/prefix-set[name=as{_as}-{af}]', {"prefix": prefixes}) )
+      with metrics.timed('prefix-set'):
+        prefixes, before = prefix_set_entries(pfx,af)
+      if aggregate_prefixes:
+        logging.info( f"AS{_as} {af}: aggregated {before} prefixes into {len(prefixes)} entries" )
+      objects.append( (f'/routing-policy/prefix-set[name=as{_as}-{af}]', {"prefix": prefixes}) )
 
-      updates.append( (PATH+f'/group[group-name={group_name}]',
+      objects.append( (bgp_path+f'/group[group-name={group_name}]',
        {
         "admin-state": "enable",
         "description": name, # from PeeringDB
@@ -163,71 +1441,567 @@ def ConfigureBGPPeering():
          ]
        })
       )
-      updates.append( (PATH+f'/neighbor[peer-address={ip}]',
+      objects.append( (bgp_path+f'/neighbor[peer-address={ip}]',
        {
           "peer-as": _as,
           "peer-group": group_name,
-          "import-policy": policy_name
-
-          # Could query https://www.peeringdb.com/api/net?asn=x and set max-prefixes
+          "import-policy": policy_name,
+          "afi-safi": [
+            {
+              "afi-safi-name": f"{af}-unicast",
+              f"{af}-unicast": {
+                "prefix-limit": {
+                  "max-received-routes": max_prefix_limit(count),
+                  "warning-threshold-pct": max_prefix_warning
+                }
+              }
+            }
+          ]
        })
       )
-      gnmi.set( encoding='json_ietf', update=updates )
+      return objects
+
+_ns = re.compile( r'^(srl_nokia-[\w-]+|ixp-agent):' )
+
+def _strip_ns(val):
+    """
+    Removes json_ietf module prefixes from keys and (identityref) values
+    """
+    if isinstance(val,dict):
+      return { _ns.sub('',k): _strip_ns(v) for k,v in val.items() }
+    if isinstance(val,list):
+      return [ _strip_ns(v) for v in val ]
+    if isinstance(val,str):
+      return _ns.sub('',val)
+    return val
+
+def _find_list(val,name):
+    """
+    Returns the entries of list 'name' in a GET response, at whatever depth
+    the response happens to be rooted
+    """
+    if isinstance(val,dict):
+      if name in val:
+        return val[name]
+      for v in val.values():
+        found = _find_list(v,name)
+        if found is not None:
+          return found
+    return None
+
+def _covers(running,desired):
+    """
+    True if the running config contains all the desired values. Lists must
+    match entry for entry (e.g. prefixes), running may have extra leaves
+    """
+    if isinstance(desired,dict):
+      return (isinstance(running,dict) and
+              all( k in running and _covers(running[k],v) for k,v in desired.items() ))
+    if isinstance(desired,list):
+      if not isinstance(running,list) or len(running)!=len(desired):
+        return False
+      if all( isinstance(d,dict) and not any(isinstance(v,(dict,list)) for v in d.values())
+              for d in desired ): # Flat entries like prefixes: sort, don't search
+        keys = sorted( set().union(*desired) )
+        def flat(e):
+          return tuple( str(e.get(k)) for k in keys )
+        return sorted(map(flat,running)) == sorted(map(flat,desired))
+      return all( any(_covers(r,d) for r in running) for d in desired )
+    return str(running) == str(desired)
+
+############################################################
+## All changes of a reconcile run form one transaction. It is
+## committed as a single Set, unless it exceeds max_set_objects or
+## max_set_bytes (e.g. large IRR prefix-sets); then it is split into
+## chunks that preserve dependency order. When a chunk fails, the
+## chunks committed before it are rolled back to the snapshot
+############################################################
+class SetTransaction:
+  def __init__(self):
+    self.ops = []           # (op,path,value,size) in dependency order
+    self.latencies = []     # Commit time per chunk, in seconds
+
+  def add(self,op,path,val=None):
+    size = len(path) + (len(json.dumps(val)) if val is not None else 0)
+    self.ops.append( (op,path,val,size) )
+
+  def __len__(self):
+    return len(self.ops)
 
-     for peer in peer_as_list:
-      (name,ip4,ip6) = query_peeringdb( peer, ixp )
-      logging.info( f"PeeringDB result: {name} {ip4} {ip6}" )
+  @staticmethod
+  def chunks(ops):
+    chunk, size = [], 0
+    for o in ops:
+      if chunk and (len(chunk) >= max_set_objects or size + o[3] > max_set_bytes):
+        yield chunk
+        chunk, size = [], 0
+      chunk.append( o ) # An oversized object still goes, in a chunk of its own
+      size += o[3]
+    if chunk:
+      yield chunk
+
+  @staticmethod
+  def _set(gnmi,chunk):
+    ops = { 'update': [], 'replace': [], 'delete': [] }
+    for (op,path,val,_) in chunk:
+      ops[op].append( path if op=='delete' else (path,val) )
+    gnmi.set( encoding='json_ietf', update=ops['update'] or None,
+              replace=ops['replace'] or None, delete=ops['delete'] or None )
+
+  def commit(self,gnmi,snapshot):
+    """
+    snapshot: { path: (owner,value) } of the running config before the
+    transaction, used to roll back committed chunks
+    """
+    done = []
+    for n, chunk in enumerate( self.chunks(self.ops) ):
+      t0 = time.monotonic()
+      try:
+        self._set(gnmi,chunk)
+      except Exception as e:
+        logging.error( f"SetTransaction: chunk {n} failed, rolling back {len(done)} objects: {e}" )
+        self.rollback(gnmi,done,snapshot)
+        raise
+      self.latencies.append( time.monotonic()-t0 )
+      logging.info( f"SetTransaction: chunk {n} ({len(chunk)} objects, "
+                    f"{sum(o[3] for o in chunk)} bytes) committed in {self.latencies[-1]*1000:.0f} ms" )
+      done += chunk
+
+  def rollback(self,gnmi,done,snapshot):
+    undo = SetTransaction()
+    for (op,path,_,_) in reversed(done):
+      if path in snapshot:
+        undo.add( 'replace', path, snapshot[path][1] )
+      elif op != 'delete':
+        undo.add( 'delete', path )
+    try:
+      for chunk in self.chunks(undo.ops):
+        self._set(gnmi,chunk)
+    except Exception as e:
+      logging.error( f"SetTransaction: rollback failed: {e}" )
+
+############################################################
+## Reconciler: computes the desired policy/prefix-set/group/neighbor
+## tree from the (cached) PeeringDB and IRR data, diffs it against
+## a snapshot of the running config and applies only the difference,
+## including deletes for AS that were removed from peer-as
+############################################################
+class Reconciler:
+  _owned = { 'prefix-set': re.compile( r'^as(\d+)-ipv[46]$' ),
+             'policy':     re.compile( r'^ix-import-(\d+)-ipv[46]$' ),
+             'group':      re.compile( r'^ix-ipv[46]$' ) }
+
+  def __init__(self,network_instance='default',js_path='.ixp_agent'):
+    self.network_instance = network_instance
+    self.bgp_path = f'/network-instance[name={network_instance}]/protocols/bgp'
+    self.js_path = js_path  # Where state is published
+    self.ixp = ""           # IXP site, e.g. "DE-CIX Frankfurt"
+    self.peer_as_list = []  # List of AS to peer with
+    self.lock = Lock()      # Only one reconcile per instance changes the config at a time
+    self.changed = 0    # Objects changed by the last run
+    self.published = set() # AS with per-peer telemetry state
+
+  def update_state(self,**kwargs):
+    telemetry.update( self.js_path,
+                      last_change=datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"), **kwargs )
+
+  def lookup(self,ix,asns,check=None):
+    """
+    Fetch stage: returns { asn: (name,ip4,ip6,prefixes,PeeringDB counts) } plus the set of AS
+    for which the lookup failed
+    """
+    t_start = time.monotonic()
+    if not asns:
+      self.unpublish( self.published )
+      self.published = set()
+      return {}, set()
+    pool = fetch_pool()
+    try:
+      # One request for all AS, shared by instances at the same IX
+      pool.submit(single_flight.do,('peeringdb',ix),refresh_peeringdb,ix).result()
+    except Exception as e:
+      logging.error( f"PeeringDB refresh failed, using cached data: {e}" )
+    try:
+      # Prefix counts, batched; only the AS not cached yet or stale
+      pool.submit(refresh_net,asns).result()
+    except Exception as e:
+      logging.error( f"PeeringDB net refresh failed, using cached prefix counts: {e}" )
+    peers, failed = {}, set()
+    futures = { pool.submit(lookup_peer,peer,ix): peer for peer in asns }
+    for f in as_completed(futures):
+      if check and not check():
+        for pending in futures:
+          pending.cancel() # Those not started yet
+        raise Superseded()
+      try:
+        (peer,name,ip4,ip6,pfx,counts,timings) = f.result()
+      except Exception as e:
+        logging.error( f"Lookup failed for AS{futures[f]}: {e}" )
+        failed.add( futures[f] )
+        continue
+      logging.info( f"PeeringDB result: {name} {ip4} {ip6} "
+                    f"({timings['peeringdb']*1000:.0f} ms)" )
       if ip4 or ip6:
-       pfx = get_prefixlist(peer)
-       logging.info( f"Prefix count: {len(pfx)}" )
-       if ip4:
-        addPeer(peer,name,ip4,"ipv4",pfx)
-       if ip6:
-        addPeer(peer,name,ip6,"ipv6",pfx)
+        logging.info( f"Prefix count: {len(pfx)} ({timings['irr']*1000:.0f} ms, "
+                      f"peak {pfx.peak} bytes), {timings['rpki_invalid']} RPKI invalid "
+                      f"({timings['rpki']*1000:.0f} ms)" )
+        peers[peer] = (name,ip4,ip6,pfx,counts)
+      self.publish_peer(peer,name,ip4,ip6,pfx,counts,timings)
+    self.unpublish( self.published - set(asns) )
+    self.published = set(asns)
+    logging.info( f"Lookup: {len(asns)} AS in {time.monotonic()-t_start:.1f}s "
+                  f"(parallelism={fetch_parallelism})" )
+    return peers, failed
+
+  def peer_js_path(self,asn):
+    return self.js_path + '.peer{.peer_as==' + str(asn) + '}'
+
+  def unpublish(self,asns):
+    for asn in asns:
+      telemetry.delete( self.peer_js_path(asn) )
+
+  def publish_peer(self,asn,name,ip4,ip6,pfx,counts,timings):
+    telemetry.update( self.peer_js_path(asn),
+      name = name or "",
+      ipv4_address = ip4 or "",
+      ipv6_address = ip6 or "",
+      ipv4_prefix_count = pfx.count(4),
+      ipv6_prefix_count = pfx.count(6),
+      ipv4_prefix_limit = max_prefix_limit(counts[0]) if ip4 else 0,
+      ipv6_prefix_limit = max_prefix_limit(counts[1]) if ip6 else 0,
+      irr_peak_memory = pfx.peak,
+      rpki_invalid_count = timings['rpki_invalid'],
+      last_lookup = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"),
+      peeringdb_lookup_time = int( timings['peeringdb']*1000 ),
+      irr_lookup_time = int( timings['irr']*1000 ) )
+
+  def desired(self,peers):
+    tree = {}
+    for peer in sorted(peers):
+      (name,ip4,ip6,pfx,counts) = peers[peer]
+      for ip,af,count in ((ip4,"ipv4",counts[0]),(ip6,"ipv6",counts[1])):
+        if ip:
+          for path,val in peer_objects(self.bgp_path,peer,name,ip,af,pfx,count):
+            tree.setdefault( path, val ) # First peer names the group
+            if '/prefix-set[' in path:
+              telemetry.update( self.peer_js_path(peer),
+                                **{ f'{af}_prefix_set_entries': len(val['prefix']) } )
+    return tree
+
+  def running(self,gnmi):
+    """
+    Single GET snapshot of the agent-owned objects in the running config,
+    returns { path: (owner AS or None, value) }
+    """
+    resp = gnmi.get( encoding='json_ietf', datatype='config',
+                     path=[ '/routing-policy', self.bgp_path ] )
+    tree = {}
+    for n in resp.get('notification',[]):
+      for u in n.get('update',[]):
+        val = _strip_ns( u['val'] )
+        for e in _find_list(val,'prefix-set') or []:
+          m = self._owned['prefix-set'].match( e['name'] )
+          if m:
+            tree[ f"/routing-policy/prefix-set[name={e['name']}]" ] = (int(m.group(1)),e)
+        for e in _find_list(val,'policy') or []:
+          m = self._owned['policy'].match( e['name'] )
+          if m:
+            tree[ f"/routing-policy/policy[name={e['name']}]" ] = (int(m.group(1)),e)
+        for e in _find_list(val,'group') or []:
+          if self._owned['group'].match( e['group-name'] ):
+            tree[ self.bgp_path+f"/group[group-name={e['group-name']}]" ] = (None,e)
+        for e in _find_list(val,'neighbor') or []:
+          if self._owned['policy'].match( str(e.get('import-policy','')) ):
+            tree[ self.bgp_path+f"/neighbor[peer-address={e['peer-address']}]" ] = (e.get('peer-as'),e)
+    return tree
+
+  # Dependency order: referenced objects are created before and deleted after
+  # the objects that refer to them, in case the transaction gets chunked
+  _order = ( 'prefix-set', 'policy', 'group', 'neighbor' )
+
+  def _kind(self,path):
+    return self._order.index( re.sub( r'\[[^]]*\]', '', path ).split('/')[-1] )
+
+  def diff(self,desired,running,keep,shared=()):
+    """
+    Returns a SetTransaction; objects owned by AS in 'keep' (failed lookups)
+    are never deleted, nor are routing-policy objects of AS in 'shared'
+    (used by other network-instances)
+    """
+    changes, deletes = [], []
+    for path,val in desired.items():
+      if path in running and _covers(running[path][1],val):
+        continue
+      # Replace policies, such that stale prefixes are removed
+      changes.append( ('replace' if '/routing-policy/' in path else 'update',path,val) )
+    for path,(owner,_) in running.items():
+      if path not in desired and owner not in keep:
+        if owner is None and keep: # Groups may still be used by kept neighbors
+          continue
+        if owner in shared and '/routing-policy/' in path:
+          continue
+        deletes.append( path )
+    txn = SetTransaction()
+    for (op,path,val) in sorted( changes, key=lambda c: self._kind(c[1]) ):
+      txn.add( op, path, val )
+    for path in sorted( deletes, key=self._kind, reverse=True ):
+      txn.add( 'delete', path )
+    return txn
+
+  def reconcile(self,gnmi,ix,asns,check=None):
+    """
+    check: optional callable, returning False once this run is superseded by
+    newer config. Checked during lookups and before anything is changed
+    """
+    t_start = time.monotonic()
+    peers, failed = self.lookup(ix,asns,check)
+    desired = self.desired(peers)
+    running = self.running(gnmi)
+    txn = self.diff(desired,running,keep=failed,shared=self.shared())
+    if check and not check():
+      raise Superseded()
+    self.changed = len(txn)
+    if self.changed:
+      txn.commit(gnmi,running)
+    logging.info( f"Reconcile {self.network_instance}: {len(desired)} desired objects, "
+                  f"{self.changed} changed in {len(txn.latencies)} chunk(s) "
+                  f"in {time.monotonic()-t_start:.1f}s" )
+    self.update_state( last_reconcile_changes=self.changed,
+                       peer_count=sum( 1 for p in desired if '/neighbor[' in p ) )
+    return self.changed
+
+  def shared(self):
+    """
+    Routing-policy objects are global, named by AS only: the AS configured
+    in other instances reference them too, as long as those are configured
+    """
+    return { asn for name,instance in list(reconcilers.items())
+             if instance is not self for asn in instance.peer_as_list }
+
+############################################################
+## One Reconciler per network-instance, each with its own IXP, AS list
+## and state. The top-level ixp-agent container configures the default
+## network-instance. Independent instances reconcile in parallel
+############################################################
+reconcilers = {}        # network-instance name -> Reconciler
+
+def ixp_instance(network_instance,js_path):
+    if network_instance not in reconcilers:
+      reconcilers[network_instance] = Reconciler(network_instance,js_path)
+    return reconcilers[network_instance]
+
+def ConfigureBGPPeering(network_instance='default',check=None):
+    global first_reconcile
+    startup_done.wait( timeout=120 ) # Phases are bounded, this is a safety net
+    instance = reconcilers[network_instance]
+    with instance.lock:
+      refresh_vrps() # In case the configured file changed
+      instance.reconcile( gnmi_connection, instance.ixp, list(instance.peer_as_list), check )
+    Update_State( gnmi_statistics=gnmi_connection.counters() )
+    if first_reconcile:
+      first_reconcile = False
+      logging.info( f"Time to first reconcile: {time.monotonic()-start_time:.2f}s" )
+
+class Superseded(Exception):
+  """ Raised inside a reconcile that was superseded by newer config """
+
+class ReconcileScheduler:
+  """
+  Runs reconciles on executor threads, such that the event loop keeps
+  handling NDK notifications and neighbor events meanwhile. Instances run
+  in parallel, one reconcile at a time each. A request while a reconcile
+  of the same instance is running supersedes it: the running one stops at
+  its next check, after which a new one starts with the latest config.
+  request() may be called from any thread
+  """
+  def __init__(self):
+    self.lock = Lock()
+    self.generation = {}    # network-instance -> counter, bumped by every request
+    self.running = {}       # network-instance -> asyncio task
+    self.loop = None
+    self.requests = None    # asyncio.Queue of network-instances
+    self.backlog = set()    # Requested before the loop was running
+
+  def request(self,network_instance='default'):
+    with self.lock:
+      self.generation[network_instance] = self.generation.get(network_instance,0) + 1
+      if self.loop is None:
+        self.backlog.add( network_instance )
+        return
+    self.loop.call_soon_threadsafe( self.requests.put_nowait, network_instance )
+
+  def current(self,network_instance,generation):
+    with self.lock:
+      return self.generation[network_instance] == generation
+
+  async def _reconcile(self,network_instance):
+    while True:
+      generation = self.generation[network_instance]
+      check = lambda: self.current(network_instance,generation)
+      try:
+        await self.loop.run_in_executor( None, ConfigureBGPPeering, network_instance, check )
+      except Superseded:
+        logging.info( f"Reconcile {network_instance} superseded by newer config, restarting" )
+      except Exception as e:
+        logging.error( f"Reconcile {network_instance} failed: {e}" )
+      if check(): # No newer request meanwhile
+        return
+
+  async def run(self):
+    with self.lock:
+      self.loop = asyncio.get_event_loop()
+      self.requests = asyncio.Queue()
+      for network_instance in self.backlog:
+        self.requests.put_nowait( network_instance )
+      self.backlog = set()
+    while True:
+      network_instance = await self.requests.get()
+      task = self.running.get( network_instance )
+      if task is None or task.done(): # Else the running task picks it up
+        self.running[network_instance] = asyncio.ensure_future( self._reconcile(network_instance) )
+
+reconcile_scheduler = ReconcileScheduler()
+metrics.queue( 'reconcile-requests', lambda: reconcile_scheduler.requests.qsize()
+                                     if reconcile_scheduler.requests else 0 )
+metrics.queue( 'reconciles-running', lambda: sum( 1 for t in list(reconcile_scheduler.running.values())
+                                                  if not t.done() ) )
 
 ##################################################################
 ## Proc to process the config Notifications received by auto_config_agent
-## At present processing config from js_path = .fib-agent
+## Config is processed from js_path .ixp_agent (for network-instance
+## default) and .network_instance.ixp_agent (keyed by network-instance)
+## Returns the network-instance to reconcile, or None
 ##################################################################
 def Handle_Notification(obj):
     if obj.HasField('config'):
-        logging.info(f"GOT CONFIG :: {obj.config.key.js_path}")
-        if ".ixp_agent" in obj.config.key.js_path:
+        js_path = obj.config.key.js_path
+        logging.info(f"GOT CONFIG :: {js_path}")
+        if js_path.startswith(".network_instance.ixp_agent") and obj.config.key.keys:
+            name = obj.config.key.keys[0]
+            if name == 'default': # Rejected by the YANG model, would overwrite the top-level config
+              logging.warning( "Ignoring ixp-agent under network-instance default, "
+                               "configure the top-level ixp-agent container instead" )
+              return None
+            instance = ixp_instance( name,
+              '.network_instance{.name=="' + name + '"}.ixp_agent' )
+        elif js_path.startswith(".ixp_agent"):
+            instance = ixp_instance( 'default', '.ixp_agent' )
+        else:
+            instance = None
+        if instance is not None:
             logging.info(f"Got config for agent, now will handle it :: \n{obj.config}\
                             Operation :: {obj.config.op}\nData :: {obj.config.data.json}")
             if obj.config.op == 2:
-                logging.info(f"Delete ixp-agent cli scenario")
-                # if file_name != None:
-                #    Update_Result(file_name, action='delete')
-                response=stub.AgentUnRegister(request=sdk_service_pb2.AgentRegistrationRequest(), metadata=metadata)
-                logging.info('Handle_Config: Unregister response:: {}'.format(response))
+                if instance.js_path == '.ixp_agent':
+                  logging.info(f"Delete ixp-agent cli scenario")
+                  # if file_name != None:
+                  #    Update_Result(file_name, action='delete')
+                  asyncio.ensure_future( Unregister() )
+                  return None
+                logging.info(f"Delete ixp-agent in network-instance {instance.network_instance}")
+                instance.ixp, instance.peer_as_list = "", []
+                return instance.network_instance # Removes its objects
             else:
                 json_acceptable_string = obj.config.data.json.replace("'", "\"")
                 data = json.loads(json_acceptable_string)
-                if 'acl_sequence_start' in data:
-                    global acl_sequence_start
-                    acl_sequence_start = int( data['acl_sequence_start']['value'] )
-                    logging.info(f"Got init sequence :: {acl_sequence_start}")
+                # Network-instances only set IXP and peer-as
+                if instance.js_path == '.ixp_agent' and Handle_Global_Config(data):
+                    for name in list(reconcilers): # The caller requests 'default'
+                        if name != 'default':
+                            reconcile_scheduler.request(name)
 
                 if 'IXP' in data:
-                    global ixp
-                    ixp = data['IXP']['value']
+                    instance.ixp = data['IXP']['value']
                 if 'peer_as' in data:
                     logging.info(f"Peer AS list : {data['peer_as']}")
-                    global peer_as_list
-                    peer_as_list = [ int(e['value']) for e in data['peer_as'] ]
+                    instance.peer_as_list = [ int(e['value']) for e in data['peer_as'] ]
 
-                try:
-                  ConfigureBGPPeering()
-                except Exception as e:
-                  logging.error(e)
-                  sys.exit(1)
-                return True
+                return instance.network_instance # Caller requests a reconcile
 
     else:
         logging.info(f"Unexpected notification : {obj}")
 
-    return False
+    return None
+
+def Handle_Global_Config(data):
+    """
+    Agent wide settings, only configurable in the top-level ixp-agent container
+    Returns True if a setting that affects the desired config of every
+    network-instance changed
+    """
+    global aggregate_prefixes, max_prefix_headroom, max_prefix_warning, rpki_vrp_file
+    before = ( aggregate_prefixes, max_prefix_headroom, max_prefix_warning, rpki_vrp_file )
+    if 'acl_sequence_start' in data:
+        global acl_sequence_start
+        acl_sequence_start = int( data['acl_sequence_start']['value'] )
+        logging.info(f"Got init sequence :: {acl_sequence_start}")
+
+    if 'fetch_parallelism' in data:
+        global fetch_parallelism
+        fetch_parallelism = int( data['fetch_parallelism']['value'] )
+
+    if 'cache_ttl' in data:
+        global cache_ttl
+        cache_ttl = int( data['cache_ttl']['value'] )
+
+    if 'event_settle_time' in data:
+        global event_settle_time
+        event_settle_time = int( data['event_settle_time']['value'] ) / 1000.0
+
+    if 'max_set_objects' in data:
+        global max_set_objects
+        max_set_objects = int( data['max_set_objects']['value'] )
+
+    if 'max_set_size' in data:
+        global max_set_bytes
+        max_set_bytes = int( data['max_set_size']['value'] )
+
+    if 'telemetry_interval' in data:
+        global telemetry_interval
+        telemetry_interval = int( data['telemetry_interval']['value'] ) / 1000.0
+
+    if 'aggregate_prefixes' in data:
+        aggregate_prefixes = data['aggregate_prefixes']['value'] in (True,'true')
+
+    if 'max_prefix_headroom' in data:
+        max_prefix_headroom = int( data['max_prefix_headroom']['value'] )
+
+    if 'max_prefix_warning_threshold' in data:
+        max_prefix_warning = int( data['max_prefix_warning_threshold']['value'] )
+
+    if 'acl_mode' in data:
+        global acl_mode
+        mode = data['acl_mode']['value'] # Enums are prefixed, e.g. ACL_MODE_per_peer
+        mode = mode[len('ACL_MODE_'):] if mode.startswith('ACL_MODE_') else mode
+        mode = mode.replace('_','-')
+        if mode not in ('per-peer','shared'):
+          logging.error( f"Unknown acl-mode {data['acl_mode']['value']}, keeping {acl_mode}" )
+        elif mode != acl_mode:
+          acl_mode = mode
+          # Migrate existing peers; Add_ACL removes the other mode's entries
+          for peer in acl_index.owned_prefixes():
+            neighbor_events.queue(None,peer,"static",'add')
+
+    if 'refresh_interval' in data:
+        global refresh_interval
+        refresh_interval = int( data['refresh_interval']['value'] )
+
+    if 'refresh_rate_limit' in data:
+        global refresh_rate_limit
+        refresh_rate_limit = int( data['refresh_rate_limit']['value'] )
+
+    if 'metrics_port' in data:
+        global metrics_port
+        metrics_port = int( data['metrics_port']['value'] )
+
+    if 'profiler_enabled' in data:
+        global profiler_enabled
+        profiler_enabled = data['profiler_enabled']['value'] in (True,'true')
+
+    if 'rpki_vrp_file' in data:
+        rpki_vrp_file = data['rpki_vrp_file']['value'] # Loaded by the reconcile
+
+    return before != ( aggregate_prefixes, max_prefix_headroom, max_prefix_warning, rpki_vrp_file )
 
 def Gnmi_subscribe_bgp_changes():
     logging.info( "Gnmi_subscribe_bgp_changes -> start subscription to BGP neighbor events" )
@@ -252,76 +2026,288 @@ def Gnmi_subscribe_bgp_changes():
                 {  # Also monitor dynamic-neighbors sections
                    'path': '/network-instance[name=*]/protocols/bgp/dynamic-neighbors/accept/match[prefix=*]',
                    'mode': 'on_change',
+                },
+                {  # Keeps the ACL index in sync with changes made by others
+                   'path': '/acl/cpm-filter/ipv4-filter/entry[sequence-id=*]',
+                   'mode': 'on_change',
+                },
+                {
+                   'path': '/acl/cpm-filter/ipv6-filter/entry[sequence-id=*]',
+                   'mode': 'on_change',
                 }
             ],
             'use_aliases': False,
             'mode': 'stream',
             'encoding': 'json'
         }
-    _bgp = re.compile( r'^network-instance\[name=([^]]*)\]/protocols/bgp/neighbor\[peer-address=([^]]*)\]/.*$' )
-    _dyn = re.compile( r'^network-instance\[name=([^]]*)\]/protocols/bgp/dynamic-neighbors/accept/match\[prefix=([^]]*)\]/.*$' )
+    resync = { 'synced': False, 'seen': set() }
+
+    def on_connect(gnmi):
+      # Events may have been missed while disconnected; the new subscription
+      # replays all neighbors, agent-created entries not replayed are removed
+      acl_index.seed(gnmi)
+      resync['synced'] = False
+      resync['seen'] = set()
+      neighbor_events.forget()
+      Update_State( gnmi_statistics=gnmi.counters() )
+
+    def on_message(m):
+      cpu = time.clock_gettime( time.CLOCK_THREAD_CPUTIME_ID )
+      try:
+        if m.HasField('sync_response'):
+          if not resync['synced']:
+            resync['synced'] = True
+            for prefix in acl_index.owned_prefixes() - resync['seen']:
+              logging.info( f"Resync: neighbor {prefix} was removed" )
+              neighbor_events.queue(None,prefix,"static",'delete')
+        elif m.HasField('update'): # both update and delete events
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+              logging.debug(f"gNMI change event :: {m}")
+            n = m.update
+            prefix = list(n.prefix.elem) if n.HasField('prefix') else []
+            if n.update:
+               # Only look at the first (top level) path; the rest is ignored
+               # without converting any of it, except for ACL entries
+               kind, a, b, depth = classify_path( prefix + list(n.update[0].path.elem) )
+               if kind == 'acl':
+                  for u in n.update:
+                     kind, v, seq, depth = classify_path( prefix + list(u.path.elem) )
+                     if kind == 'acl':
+                        leaf = [ _elem_name(e) for e in (prefix + list(u.path.elem))[4:] ]
+                        if leaf and leaf[0] not in ACL_LEARNED:
+                           gnmi_events.ignored += 1 # E.g. statistics, per matched packet
+                           continue
+                        acl_index.learn( v, int(seq), leaf, typed_value(u.val) )
+               elif kind in ('neighbor','dynamic'):
+                  peer_type = "static" if kind == 'neighbor' else "dynamic"
+                  logging.debug(f"Got {peer_type} neighbor change event :: {b}")
+                  if not resync['synced']:
+                     v, ip, plen = checkIP( b.split('/') )
+                     resync['seen'].add( ip + '/' + plen )
+                  # Updates below a neighbor already added (session state, counters,
+                  # timers) are dropped here, unless its add failed or was undone
+                  if not neighbor_events.queue(a,b,peer_type,'add',dedup=True):
+                     gnmi_events.ignored += 1
+               else:
+                  gnmi_events.ignored += 1
+            else:
+               handleDelete(prefix,n.delete)
 
-    connected = False
-    while not connected:
+      except Exception as e:
+        traceback_str = ''.join(traceback.format_tb(e.__traceback__))
+        logging.error(f'Exception caught in gNMI :: {e} m={m} stack:{traceback_str}')
+      finally:
+        gnmi_events.count( time.clock_gettime( time.CLOCK_THREAD_CPUTIME_ID ) - cpu )
+
+    logging.info( "Unix socket connected...waiting for subscribed gNMI events" )
+    gnmi_connection.subscribe_forever( subscribe, on_message, on_connect )
+
+def handleDelete(prefix,deletes):
+    for d in deletes:
+       elems = prefix + list(d.elem)
+       if logging.getLogger().isEnabledFor(logging.DEBUG):
+         logging.debug(f"handleDelete :: {'/'.join( _elem_name(e) for e in elems )}")
+       kind, a, b, depth = classify_path( elems )
+       if kind == 'acl':
+         if depth == 4: # Not for deletes of individual leaves
+           acl_index.remove( a, int(b) )
+       elif (kind == 'neighbor' and depth == 4) or (kind == 'dynamic' and depth == 6):
+         # Dynamic: also the old prefix, when it is modified
+         neighbor_events.queue(a,b,"static" if kind == 'neighbor' else "dynamic",'delete')
+       else:
+         gnmi_events.ignored += 1
+
+# ACL entry leaves used by the ACL index; updates of others are not decoded
+ACL_LEARNED = ( 'match', 'created-by-ixp-agent' )
+
+def _elem_name(e):
+    name = e.name
+    return name[name.index(':')+1:] if ':' in name else name # Strip module
+
+def classify_path(elems):
+    """
+    Classifies a gNMI path (list of PathElem) without building strings:
+    returns ('neighbor', network-instance, peer-address, depth),
+    ('dynamic', network-instance, prefix, depth),
+    ('acl', ip version, sequence-id, depth) or (None,None,None,depth)
+    """
+    depth = len(elems)
+    if depth >= 4:
+      first = _elem_name(elems[0])
+      if first == 'network-instance' and _elem_name(elems[2]) == 'bgp':
+        e = elems[3]
+        name = _elem_name(e)
+        if name == 'neighbor':
+          return 'neighbor', elems[0].key.get('name'), e.key.get('peer-address'), depth
+        if (name == 'dynamic-neighbors' and depth >= 6 and _elem_name(elems[4]) == 'accept'
+            and _elem_name(elems[5]) == 'match'):
+          return 'dynamic', elems[0].key.get('name'), elems[5].key.get('prefix'), depth
+      elif first == 'acl' and _elem_name(elems[3]) == 'entry':
+        v = 4 if _elem_name(elems[2]) == 'ipv4-filter' else 6
+        return 'acl', v, elems[3].key.get('sequence-id'), depth
+    return None, None, None, depth
+
+def typed_value(tv):
+    """
+    Decodes a gNMI TypedValue into Python values
+    """
+    kind = tv.WhichOneof('value')
+    if kind in ('json_val','json_ietf_val'):
+      return json.loads( getattr(tv,kind) )
+    return getattr(tv,kind) if kind else None
+
+class GnmiEventStats:
+  """
+  Events handled per CPU-second of the subscriber thread, published now and then
+  """
+  def __init__(self):
+    self.events = 0
+    self.ignored = 0
+    self.cpu = 0.0
+    self.published = 0.0
+
+  def count(self,cpu):
+    self.events += 1
+    self.cpu += cpu
+    now = time.monotonic()
+    if now - self.published >= 5:
+      self.published = now
+      Update_State( gnmi_events = {
+        'received': self.events, 'ignored': self.ignored,
+        'cpu_time_ms': int( self.cpu * 1000 ),
+        'per_cpu_second': int( self.events / self.cpu ) if self.cpu else 0 } )
+
+gnmi_events = GnmiEventStats()
+
+############################################################
+## A single CLI change to a bgp neighbor results in ~10 events, many
+## duplicates. Events are queued per (network-instance, peer) and only
+## the net intent (add/delete) is applied once no new events arrived
+## for event_settle_time; all settled intents go in a single gNMI Set
+############################################################
+class NeighborEventCoalescer:
+  """
+  Events arrive on the subscriber thread and are passed to the event loop
+  through an asyncio queue; the coalescing and ACL updates run as a task.
+  ACL Sets are done on an executor thread, one batch at a time, such that
+  acl_count and the ACL index only change from a single place
+  """
+  def __init__(self):
+    self.lock = Lock()
+    self.pending = {}   # (net_inst,ip_prefix) -> [intent,peer_type,last_event,count]
+    self.loop = None
+    self.events = None  # asyncio.Queue of (net_inst,ip_prefix,peer_type,intent,time)
+    self.backlog = []   # Events queued before run() started
+    self.queued = {}    # (net_inst,ip_prefix) -> last intent queued and not failed
+
+  def queue(self,net_inst,ip_prefix,peer_type,intent,dedup=False):
+    """
+    dedup: drop the event if the same intent was already queued for this
+    neighbor (and did not fail). Returns False if the event was dropped
+    """
+    event = (net_inst,ip_prefix,peer_type,intent,time.monotonic())
+    with self.lock:
+      if dedup and self.queued.get( (net_inst,ip_prefix) ) == intent:
+        return False
+      self.queued[ (net_inst,ip_prefix) ] = intent
+      if self.loop is None:
+        self.backlog.append( event )
+        return True
+    self.loop.call_soon_threadsafe( self.events.put_nowait, event )
+    return True
+
+  def forget(self):
+    """
+    Called on (re)subscribe: the replay queues every neighbor again
+    """
+    with self.lock:
+      self.queued = {}
+
+  def _done(self,ready,failed):
+    """
+    Failed intents are forgotten, such that the next event retries them.
+    A removed ACL may still be wanted for the same address in another
+    network-instance, so its add intents there are forgotten too
+    """
+    removed = { ip_prefix.split('/')[0] for (net_inst,ip_prefix),r in ready.items()
+                if r[0] == 'delete' and (net_inst,ip_prefix) not in failed }
+    with self.lock:
+      for key,intent in list(self.queued.items()):
+        if key in failed:
+          if intent == ready[key][0]: # Else queued again meanwhile
+            del self.queued[key]
+        elif intent == 'add' and key[1].split('/')[0] in removed and key not in ready:
+          del self.queued[key]
+
+  def _merge(self,event):
+    net_inst,ip_prefix,peer_type,intent,now = event
+    rec = self.pending.get( (net_inst,ip_prefix) )
+    if rec:
+      rec[0], rec[2], rec[3] = intent, now, rec[3]+1 # Last event wins
+      if intent == 'add':
+        rec[1] = peer_type
+    else:
+      self.pending[ (net_inst,ip_prefix) ] = [intent,peer_type,now,1]
+
+  def depth(self):
+    return len(self.pending) + (self.events.qsize() if self.events else 0)
+
+  def settled(self):
+    """
+    Returns (and dequeues) all intents without events for event_settle_time
+    """
+    now = time.monotonic()
+    ready = { k: r for k,r in self.pending.items() if now-r[2] >= event_settle_time }
+    for k in ready:
+      del self.pending[k]
+    wait = min( [ r[2]+event_settle_time-now for r in self.pending.values() ], default=None )
+    return ready, wait
+
+  def apply(self,gnmi,ready):
+    events = sum( r[3] for r in ready.values() )
+    batch, failed = ACLBatch(), set()
+    for (net_inst,ip_prefix),(intent,peer_type,_,_) in ready.items():
+      try: # A bad intent is skipped, the rest of the batch still goes
+        if intent == 'add':
+          Add_ACL(batch,ip_prefix.split('/'),net_inst,peer_type)
+        else:
+          Remove_ACL(batch,ip_prefix)
+      except Exception as e:
+        logging.error( f"Skipping neighbor intent {intent} {ip_prefix} ({net_inst}): {e}" )
+        failed.add( (net_inst,ip_prefix) )
+    try:
+      batch.commit(gnmi)
+      logging.info( f"Applied {len(ready)} neighbor intents from {events} events "
+                    f"in {1 if batch.updates or batch.deletes else 0} gNMI set" )
+    except Exception as e:
+      logging.error( f"Failed to apply neighbor intents {ready}: {e}" )
+      failed = set(ready)
+    self._done(ready,failed)
+
+  async def run(self,gnmi):
+    loop = asyncio.get_event_loop()
+    with self.lock:
+      self.loop, self.events = loop, asyncio.Queue()
+      for event in self.backlog:
+        self.events.put_nowait( event )
+      self.backlog = []
+    while True:
+      ready, wait = self.settled()
+      if ready:
+        try:
+          await loop.run_in_executor( None, self.apply, gnmi, ready )
+        except Exception as e: # Never end the task, that would stop the agent
+          logging.error( f"Failed to apply neighbor intents: {e}" )
+        continue # Time has passed, recheck before waiting
       try:
-        # with Namespace('/var/run/netns/srbase-mgmt', 'net'):
-        with gNMIclient(target=('unix:///opt/srlinux/var/run/sr_gnmi_server',57400),
-                                username="admin",password="NokiaSrl1!",
-                                insecure=True, debug=False) as c:
-          connected = True
-          telemetry_stream = c.subscribe(subscribe=subscribe)
-          logging.info( "Unix socket connected...waiting for subscribed gNMI events" )
-          for m in telemetry_stream:
-            try:
-              if m.HasField('update'): # both update and delete events
-                  # Filter out only toplevel events
-                  parsed = telemetryParser(m)
-                  logging.info(f"gNMI change event :: {parsed}")
-                  update = parsed['update']
-                  if update['update']:
-                     path = update['update'][0]['path']  # Only look at top level
-                     neighbor = _bgp.match( path )
-                     if neighbor:
-                        net_inst = neighbor.groups()[0]
-                        ip_prefix = neighbor.groups()[1] # plain ip
-                        peer_type = "static"
-                        logging.info(f"Got neighbor change event :: {ip_prefix}")
-                     else:
-                        dyn_group = _dyn.match( path )
-                        if dyn_group:
-                           net_inst = dyn_group.groups()[0]
-                           ip_prefix = dyn_group.groups()[1] # ip/prefix
-                           peer_type = "dynamic"
-                           logging.info(f"Got dynamic-neighbor change event :: {ip_prefix}")
-                        else:
-                          logging.info(f"Ignoring gNMI change event :: {path}")
-                          continue
-
-                     # No-op if already exists
-                     Add_ACL(c,ip_prefix.split('/'),net_inst,peer_type)
-                  else: # pygnmi does not provide 'path' for delete events
-                     handleDelete(c,m)
-
-            except Exception as e:
-              traceback_str = ''.join(traceback.format_tb(e.__traceback__))
-              logging.error(f'Exception caught in gNMI :: {e} m={m} stack:{traceback_str}')
-      except grpc.FutureTimeoutError as e:
-        logging.error( e )
-        time.sleep( 5 )
-    logging.info("Leaving BGP event loop")
-
-def handleDelete(gnmi,m):
-    logging.info(f"handleDelete :: {m}")
-    for e in m.update.delete:
-       for p in e.elem:
-         # TODO dynamic-neighbors, also modify of prefix in dynamic-neighbors
-         if p.name == "neighbor":
-           for n,v in p.key.items():
-             logging.info(f"n={n} v={v}")
-             if n=="peer-address":
-                peer_ip = v
-                Remove_ACL(gnmi,peer_ip)
-                # return # Can be multiple entries
+        self._merge( await asyncio.wait_for( self.events.get(), wait ) )
+      except asyncio.TimeoutError:
+        continue
+      while not self.events.empty():
+        self._merge( self.events.get_nowait() )
+
+neighbor_events = NeighborEventCoalescer()
+metrics.queue( 'neighbor-events', neighbor_events.depth )
 
 #
 # Checks if this is an IPv4 or IPv6 address, and normalizes host prefixes
@@ -334,116 +2320,437 @@ def checkIP( ip_prefix ):
     except ValueError:
         return None
 
-def Add_Telemetry(js_path, dict):
-    telemetry_stub = telemetry_service_pb2_grpc.SdkMgrTelemetryServiceStub(channel)
-    telemetry_update_request = telemetry_service_pb2.TelemetryUpdateRequest()
-    telemetry_info = telemetry_update_request.state.add()
-    telemetry_info.key.js_path = js_path
-    telemetry_info.data.json_content = json.dumps(dict)
-    logging.info(f"Telemetry_Update_Request :: {telemetry_update_request}")
-    telemetry_response = telemetry_stub.TelemetryAddOrUpdate(request=telemetry_update_request, metadata=metadata)
-    logging.info(f"TelemetryAddOrUpdate response:{telemetry_response}")
-    return telemetry_response
+############################################################
+## Telemetry publisher: state is kept in memory and only the parts
+## that changed are sent, at most once per telemetry_interval, in a
+## single TelemetryUpdateRequest over a reused stub. A burst of ACL
+## events thus results in a single NDK RPC
+############################################################
+class TelemetryPublisher:
+  """
+  update() and delete() may be called from any thread; the NDK calls are
+  made by the run() task on the event loop
+  """
+  def __init__(self):
+    self.lock = Lock()
+    self.state = {}         # js_path -> data
+    self.dirty = set()      # js_paths to update
+    self.deleted = set()    # js_paths to delete
+    self.loop = None
+    self.wakeup = None      # asyncio.Event, created in run()
+    self.stub = None
+
+  def _wake(self):
+    if self.loop is not None:
+      self.loop.call_soon_threadsafe( self.wakeup.set )
+
+  def update(self,js_path,**kwargs):
+    with self.lock:
+      self.state.setdefault( js_path, {} ).update( kwargs )
+      self.dirty.add( js_path )
+      self.deleted.discard( js_path )
+    self._wake()
+
+  def delete(self,js_path):
+    with self.lock:
+      if self.state.pop( js_path, None ) is not None:
+        self.dirty.discard( js_path )
+        self.deleted.add( js_path )
+    self._wake()
+
+  async def flush(self):
+    with self.lock:
+      # TelemetryAddOrUpdate replaces the data for a js_path as a whole
+      dirty = { p: json.dumps(self.state[p]) for p in self.dirty }
+      deleted = list(self.deleted)
+      self.dirty.clear()
+      self.deleted.clear()
+    if not (dirty or deleted):
+      return
+    # To report state back
+    import telemetry_service_pb2, telemetry_service_pb2_grpc
+    if self.stub is None:
+      self.stub = telemetry_service_pb2_grpc.SdkMgrTelemetryServiceStub(channel)
+    t0 = time.perf_counter()
+    try:
+      if dirty:
+        request = telemetry_service_pb2.TelemetryUpdateRequest()
+        for js_path,data in dirty.items():
+          telemetry_info = request.state.add()
+          telemetry_info.key.js_path = js_path
+          telemetry_info.data.json_content = data
+        response = await self.stub.TelemetryAddOrUpdate(request=request, metadata=metadata)
+        logging.info(f"TelemetryAddOrUpdate: {len(dirty)} paths, response:{response}")
+      if deleted:
+        request = telemetry_service_pb2.TelemetryDeleteRequest()
+        for js_path in deleted:
+          request.key.add().js_path = js_path
+        response = await self.stub.TelemetryDelete(request=request, metadata=metadata)
+        logging.info(f"TelemetryDelete: {len(deleted)} paths, response:{response}")
+    except grpc.RpcError as e:
+      logging.error( f"Telemetry update failed, will retry: {e}" )
+      with self.lock:
+        self.dirty.update( p for p in dirty if p in self.state )
+        self.deleted.update( deleted )
+    metrics.observe( 'telemetry-publish', time.perf_counter()-t0 )
+
+  def depth(self):
+    with self.lock:
+      return len(self.dirty) + len(self.deleted)
+
+  async def run(self):
+    self.wakeup = asyncio.Event()
+    self.wakeup.set() # Flush what was queued before the loop was running
+    self.loop = asyncio.get_event_loop()
+    while True:
+      await self.wakeup.wait()
+      self.wakeup.clear()
+      await self.flush()
+      await asyncio.sleep( telemetry_interval ) # Bounds the rate of NDK RPCs
+
+telemetry = TelemetryPublisher()
+metrics.queue( 'telemetry-pending', telemetry.depth )
+
+def Update_State(**kwargs):
+    telemetry.update( ".ixp_agent",
+                      last_change=datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"), **kwargs )
 
 def Update_ACL_Counter(delta):
     global acl_count
     acl_count += delta
-    _ts = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
-    Add_Telemetry( ".ixp_agent", { "acl_count"   : acl_count,
-                                       "last_change" : _ts } )
+    Update_State( acl_count=acl_count )
+
+class ACLBatch:
+  """
+  Collects ACL changes for a single gNMI Set, and updates the index after
+  """
+  def __init__(self):
+    self.updates = []
+    self.deletes = []
+    self.added = []     # (v,seq,prefix,port)
+    self.removed = []   # (v,seq)
+    self.joined = []    # (v,prefix) added to the shared prefix-list
+    self.left = []      # (v,prefix) removed from the shared prefix-list
 
-def Add_ACL(gnmi,ip_prefix,net_inst,peer_type):
-    seq, next_seq, v, ip, prefix = Find_ACL_entry(gnmi,ip_prefix) # Also returns next available entry
+  def has(self,v,prefix):
+    return ( any( a[0]==v and a[2]==prefix for a in self.added ) or
+             (v,prefix) in self.joined )
+
+  def commit(self,gnmi):
+    if not (self.updates or self.deletes):
+      return
+    try:
+      gnmi.set( encoding='json_ietf', update=self.updates or None,
+                delete=self.deletes or None )
+    except Exception:
+      for (v,seq,_,_) in self.added:
+        acl_index.release(v,seq)
+      raise
+    for (v,seq,prefix,port) in self.added:
+      acl_index.add( v, seq, prefix, port )
+    for (v,seq) in self.removed:
+      acl_index.remove( v, seq )
+    for (v,prefix) in self.joined:
+      acl_index.join( v, prefix )
+    for (v,prefix) in self.left:
+      acl_index.leave( v, prefix )
+    Update_ACL_Counter( len(self.added) - len(self.removed) )
+    if self.joined or self.left:
+      Update_State( shared_acl_members=acl_index.member_count() )
+
+def Shared_List(v):
+    return f"{shared_acl_list}-ipv{v}"
+
+def _acl_entry(v,source_ip,port,description):
+    return {
+     "created-by-ixp-agent": datetime.now().strftime("%Y-%m-%d %H:%M:%S UTC"),
+     "description": description,
+     "match": {
+       ("protocol" if v==4 else "next-header"): "tcp",
+       "source-ip": source_ip,
+       port : { "operator": "eq", "value": 179 }
+     },
+     "action": { "accept": { } },
+    }
+
+def Add_ACL(batch,ip_prefix,net_inst,peer_type):
+    v, ip, prefix = checkIP( ip_prefix )
+    if batch.has(v, ip + '/' + prefix): # Same peer in multiple network-instances
+        return
+    if acl_mode == 'shared':
+        Join_Shared_ACL(batch,v,ip + '/' + prefix)
+        return
+    _leave_shared(batch,v,ip + '/' + prefix) # In case the mode was changed
+    seq, next_seq, v, ip, prefix = Find_ACL_entry(ip_prefix) # Also returns next available entry
     if seq is None:
-        updates = []
+        seqs = [ next_seq, acl_index.allocate(v) ]
+        where = f" in network-instance {net_inst}" if net_inst else ""
         for i in range(0,2):
-          acl_entry = {
-           "created-by-ixp-agent": datetime.now().strftime("%Y-%m-%d %H:%M:%S UTC"),
-           "description": f"BGP ({peer_type}) peer in network-instance {net_inst}",
-           "match": {
-             ("protocol" if v==4 else "next-header"): "tcp",
-             "source-ip": { "prefix": ip + '/' + prefix },
-             match_port[i] : { "operator": "eq", "value": 179 }
-           },
-           "action": { "accept": { } },
-          }
-          path = f'/acl/cpm-filter/ipv{v}-filter/entry[sequence-id={next_seq+i}]'
+          acl_entry = _acl_entry( v, { "prefix": ip + '/' + prefix }, match_port[i],
+                                  f"BGP ({peer_type}) peer{where}" )
+          path = f'/acl/cpm-filter/ipv{v}-filter/entry[sequence-id={seqs[i]}]'
           logging.info(f"Update: {path}={acl_entry}")
-          updates.append( (path,acl_entry) )
-        gnmi.set( encoding='json_ietf', update=updates )
+          batch.updates.append( (path,acl_entry) )
+          batch.added.append( (v,seqs[i],ip + '/' + prefix,match_port[i]) )
 
         # Need to set state separately, not via gNMI. Uses underscores in path
         # Tried extending ACL entries, but system won't accept these updates
         # js_path = (f'.acl.cpm_filter.ipv{v}_filter.entry' +
         #            '{.sequence_id==' + str(next_seq) + '}.bgp_acl_agent_state')
         # js_path = '.bgp_acl_agent.entry{.ip=="'+peer_ip+'"}'
-        # Add_Telemetry( js_path, { "sequence_id": next_seq } )
-        Update_ACL_Counter( +2 )
+        # telemetry.update( js_path, sequence_id=next_seq )
 
-def Remove_ACL(gnmi,peer_ip):
-   seq, next_seq, v, ip, prefix = Find_ACL_entry(gnmi,[peer_ip])
-   if seq is not None:
-       logging.info(f"Remove_ACL: Deleting ACL entry :: {seq}")
-       path = f'/acl/cpm-filter/ipv{v}-filter/entry[sequence-id={seq}]'
-       gnmi.set( encoding='json_ietf', delete=[path] )
-       Update_ACL_Counter( -1 )
-   else:
+#
+# Shared mode: one prefix-list per address family holds all BGP peer
+# addresses, referenced by a fixed pair of cpm-filter entries (source and
+# destination port 179). Adding or removing a peer only changes the list
+# membership, the number of CPM entries stays constant
+#
+def Join_Shared_ACL(batch,v,peer_prefix):
+    _remove_peer_entries(batch,v,peer_prefix) # In case the mode was changed
+    if acl_index.is_member(v,peer_prefix):
+        return
+    name = Shared_List(v)
+    path = f'/acl/match-list/ipv{v}-prefix-list[name={name}]'
+    logging.info(f"Update: {path} add {peer_prefix}")
+    batch.updates.append( (path, { "prefix": [ { "prefix": peer_prefix } ] }) )
+    batch.joined.append( (v,peer_prefix) )
+
+    # The list must exist before the entries referencing it, same Set
+    if acl_index.lookup(v,'@'+name) is None and not batch.has(v,'@'+name):
+        for i in range(0,2):
+          seq = acl_index.allocate(v)
+          acl_entry = _acl_entry( v, { "prefix-list": name }, match_port[i],
+                                  "BGP peers (shared by all peers)" )
+          path = f'/acl/cpm-filter/ipv{v}-filter/entry[sequence-id={seq}]'
+          logging.info(f"Update: {path}={acl_entry}")
+          batch.updates.append( (path,acl_entry) )
+          batch.added.append( (v,seq,'@'+name,match_port[i]) )
+
+def _leave_shared(batch,v,peer_prefix):
+    if acl_index.is_member(v,peer_prefix) and (v,peer_prefix) not in batch.left:
+        path = f'/acl/match-list/ipv{v}-prefix-list[name={Shared_List(v)}]/prefix[prefix={peer_prefix}]'
+        logging.info(f"Remove_ACL: Deleting {path}")
+        batch.deletes.append( path )
+        batch.left.append( (v,peer_prefix) )
+        _drop_shared(batch,v)
+        return True
+    return False
+
+def _drop_shared(batch,v):
+    """
+    Once the last member leaves (e.g. when migrating to per-peer), the shared
+    entries and the prefix-list are deleted too, in the same Set
+    """
+    name = Shared_List(v)
+    path = f'/acl/match-list/ipv{v}-prefix-list[name={name}]'
+    left = { p for (w,p) in batch.left if w == v }
+    if ( path in batch.deletes or acl_index.members_of(v) - left or
+         any( w == v for (w,_) in batch.joined ) ):
+        return
+    logging.info(f"Remove_ACL: No members left, deleting {path} and its entries")
+    batch.deletes[:] = [ d for d in batch.deletes if not d.startswith(path + '/') ]
+    _remove_peer_entries(batch,v,'@'+name)
+    batch.deletes.append( path )
+
+def _remove_peer_entries(batch,v,peer_prefix):
+    found = False
+    for port in match_port.values():
+        seq = acl_index.lookup( v, peer_prefix, port )
+        if seq is None:
+            continue
+        found = True
+        if (v,seq) not in batch.removed: # Same peer in multiple network-instances
+            logging.info(f"Remove_ACL: Deleting ACL entry :: {seq}")
+            batch.deletes.append( f'/acl/cpm-filter/ipv{v}-filter/entry[sequence-id={seq}]' )
+            batch.removed.append( (v,seq) )
+    return found
+
+def Remove_ACL(batch,peer_ip):
+   v, ip, prefix = checkIP( peer_ip.split('/') )
+   # Both, such that entries created before a change of acl-mode are removed too
+   found = _remove_peer_entries(batch,v,ip + '/' + prefix)
+   if not _leave_shared(batch,v,ip + '/' + prefix) and not found:
        logging.info(f"Remove_ACL: No entry found for peer_ip={peer_ip}")
 
 #
 # Because it is possible that ACL entries get saved to 'startup', the agent may
-# not have a full map of sequence number to peer_ip. Therefore, we perform a
-# lookup based on IP address each time
-# Since 'prefix' is not a key, we have to loop through all entries with a prefix
+# not have a full map of sequence number to peer_ip. Therefore, the index is
+# seeded from a single GET of all cpm-filter entries when the gNMI subscription
+# starts, and kept up to date from the subscribed ACL events afterwards.
+# Since 'prefix' is not a key, the index maps (af, prefix, port) to sequence-id
+# and keeps track of free sequence ids starting at acl_sequence_start.
+# The shared entries (acl-mode shared) are indexed as prefix '@<prefix-list>',
+# the members of the shared prefix-lists are tracked per address family
 #
-def Find_ACL_entry(gnmi,ip_prefix):
-   v, ip, prefix = checkIP( ip_prefix )
+class ACLIndex:
+  def __init__(self):
+    self.lock = Lock()
+    self._reset()
+
+  def _reset(self):
+    self.seeded = False
+    self.start = acl_sequence_start
+    self.entries = {}                 # (v,prefix,port) -> sequence-id
+    self.seqs = { 4: {}, 6: {} }      # v -> sequence-id -> [prefix,{ports}]
+    self.free = { 4: [], 6: [] }      # v -> min-heap of released sequence-ids
+    self.next = { 4: self.start, 6: self.start } # v -> high-water mark
+    self.members = { 4: set(), 6: set() } # v -> prefixes in the shared prefix-list
+
+  def seed(self,gnmi):
+    """
+    Single GET for both address families; Interestingly, datatype='config' is
+    required to see custom config state. The default datatype='all' does not
+    """
+    paths = [ f'/acl/cpm-filter/ipv{v}-filter/entry' for v in (4,6) ]
+    acl_entries = gnmi.get( encoding='json_ietf', datatype='config', path=paths )
+    with self.lock:
+      self._reset()
+      for e in acl_entries['notification']:
+        for u in e.get('update',[]):
+          v = 6 if 'ipv6-filter' in u.get('path','') else 4
+          for j in _find_list( _strip_ns(u['val']), 'entry' ) or []:
+            self._learn_entry( v, j['sequence-id'], j )
+      self.seeded = True
+    try:
+      paths = [ f'/acl/match-list/ipv{v}-prefix-list[name={Shared_List(v)}]' for v in (4,6) ]
+      lists = gnmi.get( encoding='json_ietf', datatype='config', path=paths )
+      with self.lock:
+        for e in lists['notification']:
+          for u in e.get('update',[]):
+            v = 6 if 'ipv6-prefix-list' in u.get('path','') else 4
+            for j in _find_list( _strip_ns(u['val']), 'prefix' ) or []:
+              self.members[v].add( j['prefix'] )
+    except Exception as e: # Not supported by all releases
+      logging.info( f"ACLIndex: no shared prefix-lists: {e}" )
+    logging.info( f"ACLIndex: seeded with {len(self.entries)} BGP entries, "
+                  f"used={len(self.seqs[4])}/{len(self.seqs[6])} (ipv4/ipv6)" )
+
+  def _learn_entry(self,v,seq,entry):
+    rec = self.seqs[v].setdefault( int(seq), [None,set(),False] )
+    if 'created-by-ixp-agent' in entry:
+      rec[2] = True
+    match = entry.get('match',{})
+    if 'source-ip' in match and 'prefix' in match['source-ip']:
+      rec[0] = match['source-ip']['prefix']
+    elif 'source-ip' in match and 'prefix-list' in match['source-ip']:
+      rec[0] = '@' + match['source-ip']['prefix-list']
+    for port in match_port.values():
+      if match.get(port,{}).get('value') == 179:
+        rec[1].add( port )
+    if rec[0]:
+      for port in rec[1]:
+        self.entries[ (v,rec[0],port) ] = int(seq)
+
+  def learn(self,v,seq,leaf,val):
+    """
+    Applies a subscription update for an ACL entry (or one of its leaves,
+    'leaf' being the list of names below the entry)
+    """
+    # Rebuild the nested 'match' container from a leaf-level update
+    for name in reversed( leaf ):
+      val = { name: val }
+    with self.lock:
+      self._learn_entry( v, seq, _strip_ns(val) if isinstance(val,dict) else {} )
 
-   #
-   # Can do it like this and add custom state, but then we cannot find the next
-   # available sequence number we can use
-   # path = f"/bgp-acl-agent/entry[ip={peer_ip}]"
-   path = f'/acl/cpm-filter/ipv{v}-filter/entry/match/'
-   # could add /source-ip/prefix but then we cannot check for dest-port
+  def lookup(self,v,prefix,port=None):
+    """
+    Returns the sequence-id of a BGP entry for the given prefix, or None
+    """
+    with metrics.timed('acl-lookup'), self.lock:
+      for p in ([port] if port else match_port.values()):
+        seq = self.entries.get( (v,prefix,p) )
+        if seq is not None:
+          return seq
+    return None
 
-   # Could filter like this to reduce #entries, limits to max 999 entries
-   # path = '/acl/cpm-filter/ipv4-filter/entry[sequence-id=1*]/match
+  def allocate(self,v):
+    """
+    Reserves the lowest free sequence-id >= acl_sequence_start, O(log N)
+    """
+    with self.lock:
+      if self.start != acl_sequence_start: # Users could change acl_sequence_start
+        self.start = acl_sequence_start
+        self.free = { 4: [], 6: [] }
+        self.next = { 4: self.start, 6: self.start }
+      used, free = self.seqs[v], self.free[v]
+      while free:
+        seq = heapq.heappop( free )
+        if seq not in used and seq >= self.start:
+          break
+      else:
+        while self.next[v] in used:
+          self.next[v] += 1
+        seq = self.next[v]
+        self.next[v] += 1
+      used[seq] = [None,set(),True] # Reserved
+      return seq
 
-   # Interestingly, datatype='config' is required to see custom config state
-   # The default datatype='all' does not show it
-   acl_entries = gnmi.get( encoding='json_ietf', path=[path] )
-   logging.info(f"Find_ACL_entry({ip_prefix}): GOT gNMI GET response")
+  def add(self,v,seq,prefix,port):
+    with self.lock:
+      self.seqs[v][seq] = [prefix,{port},True]
+      self.entries[ (v,prefix,port) ] = seq
+
+  def owned_prefixes(self):
+    """
+    Returns the prefixes of all BGP entries created by this agent, and
+    the members of the shared prefix-lists
+    """
+    with self.lock:
+      return ( { rec[0] for v in (4,6) for rec in self.seqs[v].values()
+                 if rec[0] and rec[2] and rec[0][0] != '@' } |
+               self.members[4] | self.members[6] )
+
+  def is_member(self,v,prefix):
+    with self.lock:
+      return prefix in self.members[v]
+
+  def members_of(self,v):
+    with self.lock:
+      return set( self.members[v] )
+
+  def join(self,v,prefix):
+    with self.lock:
+      self.members[v].add( prefix )
+
+  def leave(self,v,prefix):
+    with self.lock:
+      self.members[v].discard( prefix )
+
+  def member_count(self):
+    with self.lock:
+      return len(self.members[4]) + len(self.members[6])
+
+  def remove(self,v,seq):
+    with self.lock:
+      rec = self.seqs[v].pop( seq, None )
+      if rec and rec[0]:
+        for port in rec[1]:
+          if self.entries.get( (v,rec[0],port) ) == seq:
+            del self.entries[ (v,rec[0],port) ]
+      if seq < self.next[v]:
+        heapq.heappush( self.free[v], seq )
+
+  def release(self,v,seq):
+    """
+    Returns a sequence-id obtained from allocate() that ended up unused
+    """
+    self.remove(v,seq)
+
+acl_index = ACLIndex()
+
+def Find_ACL_entry(ip_prefix):
+   """
+   Returns the sequence-id of an existing BGP ACL entry for the given ip/prefix,
+   or None plus a newly reserved sequence-id to use
+   """
+   v, ip, prefix = checkIP( ip_prefix )
    searched = ip + '/' + prefix
-   global acl_sequence_start
-   next_seq = acl_sequence_start
-   for e in acl_entries['notification']:
-     try:
-      if 'update' in e:
-        logging.info(f"GOT Update :: {e['update']}")
-        for u in e['update']:
-            for j in u['val']['entry']:
-               logging.info(f"Check ACL entry :: {j}")
-               match = j['match']
-               # Users could change acl_sequence_start
-               for i in range(0,2):
-                if "source-ip" in match: # and j['sequence-id'] >= acl_sequence_start:
-                  src_ip = match[ "source-ip" ]
-                  if 'prefix' in src_ip:
-                     if (src_ip['prefix'] == searched):
-                       logging.info(f"Find_ACL_entry: Found matching entry :: {j}")
-                       # Perform extra sanity check
-                       key_name = match_port[i]
-                       if (key_name in match
-                            and 'value' in match[key_name]
-                            and match[key_name]['value'] == 179):
-                           return (j['sequence-id'],None,v,ip,prefix)
-                       else:
-                           logging.info( "Source/Dest IP match but not BGP port" )
-                     if j['sequence-id']==next_seq:
-                       logging.info( f"Increment next_seq (={next_seq})" )
-                       next_seq += 1
-     except Exception as e:
-        logging.error(f'Exception caught in Find_ACL_entry :: {e}')
+   seq = acl_index.lookup( v, searched )
+   if seq is not None:
+     logging.info(f"Find_ACL_entry: Found matching entry :: {seq}")
+     return (seq,None,v,ip,prefix)
+   next_seq = acl_index.allocate( v )
    logging.info(f"Find_ACL_entry: no match for searched={searched} next_seq={next_seq}")
    return (None,next_seq,v,ip,prefix)
 
@@ -453,61 +2760,110 @@ def Find_ACL_entry(gnmi,ip_prefix):
 ## Waits on the subscribed Notifications and once any config is received, handles that config
 ## If there are critical errors, Unregisters the fib_agent gracefully.
 ##################################################################################################
-def Run():
+async def Ndk_Notifications(stream_id):
+    """
+    Handles NDK notifications as they arrive; config changes only request
+    a reconcile, which runs (or supersedes a running one) in the background
+    """
+    import sdk_service_pb2, sdk_service_pb2_grpc
     sub_stub = sdk_service_pb2_grpc.SdkNotificationServiceStub(channel)
+    stream_request = sdk_service_pb2.NotificationStreamRequest(stream_id=stream_id)
+    async for r in sub_stub.NotificationStream(stream_request, metadata=metadata):
+        logging.info(f"NOTIFICATION:: \n{r.notification}")
+        for obj in r.notification:
+            network_instance = Handle_Notification(obj)
+            if network_instance:
+                reconcile_scheduler.request(network_instance)
+    # Without config notifications the agent is of no use; Run() exits
+    raise RuntimeError( "NDK notification stream ended" )
+
+async def Agent_Main():
+    """
+    Single event loop: the NDK notification stream, reconcile scheduling,
+    neighbor event coalescing and telemetry run as tasks. Blocking work
+    (PeeringDB/IRR fetches, pygnmi calls, the gNMI subscription) runs on
+    threads and hands results to the loop through queues
+    """
+    import sdk_service_pb2, sdk_service_pb2_grpc
+    from grpc import aio
+    global channel, stub
+    t0 = time.monotonic()
+    loop = asyncio.get_event_loop()
+    channel = aio.insecure_channel(sdk_mgr_address)
+    stub = sdk_service_pb2_grpc.SdkMgrServiceStub(channel)
 
-    # On startup, wait a few seconds before registering to make sure DNS/BGP config is in place
-    logging.info("Waiting 30s to let DNS/BGP config settle in...")
-    time.sleep(30)
+    # Register right away; DNS/gNMI readiness is awaited before the first reconcile
+    loop.run_in_executor( None, Startup_Readiness )
 
-    response = stub.AgentRegister(request=sdk_service_pb2.AgentRegistrationRequest(), metadata=metadata)
+    response = await stub.AgentRegister(request=sdk_service_pb2.AgentRegistrationRequest(), metadata=metadata)
     logging.info(f"Registration response : {response.status}")
 
     request=sdk_service_pb2.NotificationRegisterRequest(op=sdk_service_pb2.NotificationRegisterRequest.Create)
-    create_subscription_response = stub.NotificationRegister(request=request, metadata=metadata)
+    create_subscription_response = await stub.NotificationRegister(request=request, metadata=metadata)
     stream_id = create_subscription_response.stream_id
     logging.info(f"Create subscription response received. stream_id : {stream_id}")
 
-    Subscribe_Notifications(stream_id)
+    await Subscribe_Notifications(stream_id)
+    logging.info( f"Startup phase ndk-register: {(time.monotonic()-t0)*1000:.0f} ms" )
 
-    stream_request = sdk_service_pb2.NotificationStreamRequest(stream_id=stream_id)
-    stream_response = sub_stub.NotificationStream(stream_request, metadata=metadata)
+    # Blocking loops that never return get their own (daemon) thread
+    Thread( target=RPKI_Watcher, daemon=True ).start()
+    Thread( target=Gnmi_subscribe_bgp_changes, daemon=True ).start()
 
-    # Pause for now
-    # Thread( target=Gnmi_subscribe_bgp_changes ).start()
+    await asyncio.gather( Ndk_Notifications(stream_id),
+                          reconcile_scheduler.run(),
+                          neighbor_events.run(gnmi_connection),
+                          refresh_scheduler.run(),
+                          metrics.run(),
+                          telemetry.run() )
 
+async def Unregister():
+    if stub is None: # Not registered yet
+        return
+    import sdk_service_pb2
     try:
-        for r in stream_response:
-            logging.info(f"NOTIFICATION:: \n{r.notification}")
-            for obj in r.notification:
-                Handle_Notification(obj)
+        response = await stub.AgentUnRegister(request=sdk_service_pb2.AgentRegistrationRequest(), metadata=metadata)
+        logging.info( f'AgentUnRegister response:: {response}' )
+    except grpc.RpcError as err:
+        logging.info( f'AgentUnRegister failed - GOING TO EXIT NOW: {err}' )
 
-    except grpc._channel._Rendezvous as err:
+def Run():
+    global main_task
+    loop = asyncio.get_event_loop()
+    main_task = asyncio.ensure_future( Agent_Main() )
+    loop.add_signal_handler( signal.SIGTERM, Exit_Gracefully, signal.SIGTERM, None )
+    loop.add_signal_handler( signal.SIGUSR1, profiler.toggle )
+    try:
+        loop.run_until_complete( main_task )
+    except asyncio.CancelledError:
+        logging.info( 'Agent stopped' )
+    except grpc.RpcError as err:
         logging.info(f'GOING TO EXIT NOW: {err}')
-
     except Exception as e:
         logging.error(f'Exception caught :: {e}')
     finally:
-        Exit_Gracefully(0,0)
-    return True
+        loop.run_until_complete( Unregister() )
+        # sys.exit() would wait for executor threads: a running reconcile, or
+        # the readiness phases, could delay exit beyond the SR Linux kill timeout.
+        # Their state (SQLite cache, router config) is transactional
+        logging.info( 'Exiting' )
+        logging.shutdown()
+        os._exit( 0 )
+
 ############################################################
 ## Gracefully handle SIGTERM signal
 ## When called, will unregister Agent and gracefully exit
 ############################################################
 def Exit_Gracefully(signum, frame):
     logging.info( f"Caught signal :: {signum}\n will unregister bgp acl agent" )
-    try:
-        response=stub.AgentUnRegister(request=sdk_service_pb2.AgentRegistrationRequest(), metadata=metadata)
-        logging.info( f'Exit_Gracefully AgentUnRegister response:: {response}' )
-    except grpc._channel._Rendezvous as err:
-        logging.info( f'_Rendezvous error - GOING TO EXIT NOW: {err}' )
-    finally:
+    if main_task is None: # Event loop not running yet
         sys.exit()
+    main_task.cancel() # Run() unregisters and exits
 
 ##################################################################################################
 ## Main from where the Agent starts
 ## Log file is written to: /var/log/srlinux/stdout/bgp_acl_agent.log
-## Signals handled for graceful exit: SIGTERM
+## Signals handled for graceful exit: SIGTERM; SIGUSR1 toggles the profiler (profiler-enabled)
 ##################################################################################################
 if __name__ == '__main__':
     # hostname = socket.gethostname()